@@ -0,0 +1,23 @@
+function load_more_tickets() {
+	var link = $(this);
+	$.get(link.attr('href'), {rows: 1}, function(data) {
+		var page = $('<div/>').html(data);
+		var table = $('table.ticket_list');
+		var total = table.find('tr.total');
+		if (total.length)
+			total.before(page.find('tr'));
+		else
+			table.find('tr:last').after(page.find('tr'));
+		
+		var next = page.find('a.next-page');
+		if (next.length)
+			link.attr('href', next.attr('href'));
+		else
+			link.remove();
+	});
+	return false;
+}
+
+$(document).ready(function() {
+	$('a.load-more').click(load_more_tickets);
+});
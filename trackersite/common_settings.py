@@ -11,6 +11,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'tracker.middleware.ClusterUpdateMiddleware',
 )
 
 TEMPLATE_DIRS = (
@@ -64,6 +65,19 @@ MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 
 TRACKER_CURRENCY = _('CZK')
 
+# when on, cluster/payment status updates are only queued and left for
+# the process_cluster_updates management command (run it from cron or with --loop)
+TRACKER_CLUSTER_UPDATE_QUEUE = False
+
+# number of tickets on a page of the ticket list
+TRACKER_TICKETS_PER_PAGE = 100
+
+# number of users on a page of the user list
+TRACKER_USERS_PER_PAGE = 100
+
+# number of transactions on a page of the transaction list
+TRACKER_TRANSACTIONS_PER_PAGE = 100
+
 LANGUAGES = (
     ('en', _('English')),
     ('cs', _('Czech')),
@@ -21,11 +21,12 @@ class AddAckForm(forms.Form):
 
 class TicketAdmin(admin.ModelAdmin):
     def queryset(self, request):
-        qs = super(TicketAdmin, self).queryset(request)
+        # the changelist keeps this select_related; requester is nullable, so list_select_related would skip it
+        qs = super(TicketAdmin, self).queryset(request).select_related('topic', 'requested_user')
         if request.user.has_perm('tracker.supervisor'):
             return qs
         else:
-            return qs.extra(where=['topic_id in (select topic_id from tracker_topic_admin where user_id = %s)'], params=[request.user.id])
+            return qs.filter(topic__admin=request.user)
     
     def change_view(self, request, object_id, extra_context=None):
         extra_context = extra_context or {}
@@ -35,11 +36,11 @@ class TicketAdmin(admin.ModelAdmin):
         extra_context['add_ack_form'] = AddAckForm()
         return super(TicketAdmin, self).change_view(request, object_id, extra_context=extra_context)
     
-    exclude = ('updated', 'sort_date', 'cluster')
+    exclude = ('updated', 'sort_date', 'cluster', 'cluster_update_pending', 'ack_mask', 'state', 'row_version')
     readonly_fields = ('state_str', 'payment_status', 'requested_user_details')
     list_display = ('sort_date', 'id', 'summary', 'topic', 'requested_by', 'state_str', 'payment_status')
     list_display_links = ('summary',)
-    list_filter = ('topic', 'payment_status')
+    list_filter = ('topic', 'state', 'payment_status')
     date_hierarchy = 'sort_date'
     search_fields = ['id', 'requested_user__username', 'requested_text', 'summary']
     inlines = [MediaInfoAdmin, ExpeditureAdmin]
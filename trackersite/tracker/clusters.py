@@ -1,7 +1,27 @@
 # -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Sum
+from django.dispatch import Signal
 
 import tracker
 
+# maximum number of ids passed into a single "IN (...)" clause
+CHUNK_SIZE = 500
+
+# sent with the ClusterChanges whenever a cluster update has written some
+clusters_updated = Signal(providing_args=['changes'])
+
+def chunked(ids, size=CHUNK_SIZE):
+    """ Splits an iterable of ids into sorted lists of at most `size` items. """
+    ids = sorted(ids)
+    for i in xrange(0, len(ids), size):
+        yield ids[i:i+size]
+
 class ClusterGroup(object):
     """ Group of ticket and transaction id sets for cluster assembly. """
     def __init__(self, tickets=None, transactions=None):
@@ -21,95 +41,629 @@ class ClusterGroup(object):
     def has_items(self):
         return self.has_tickets() or self.has_transactions()
 
+class UnionFind(object):
+    """ Disjoint-set forest over hashable items. """
+    def __init__(self):
+        self.parent = {}
+    
+    def add(self, item):
+        self.parent.setdefault(item, item)
+    
+    def find(self, item):
+        parent = self.parent
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root: # path compression
+            parent[item], item = root, parent[item]
+        return root
+    
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_a] = root_b
+    
+    def groups(self):
+        out = {}
+        for item in self.parent:
+            out.setdefault(self.find(item), []).append(item)
+        return out.values()
+
+class ClusterGraph(object):
+    """
+    Ticket-transaction payment links, loaded in bulk. Items are identified
+    by ('ticket', id) and ('transaction', id) tuples.
+    """
+    def __init__(self):
+        self.tickets = {} # ticket_id -> (cluster_id, payment_status) as stored
+        self.transactions = {} # transaction_id -> (cluster_id, amount) as stored
+        self.links = set() # (ticket_id, transaction_id) pairs
+        self.old_clusters = set() # cluster ids currently referenced by loaded items
+    
+    @staticmethod
+    def _link_model():
+        return tracker.models.Transaction.tickets.through
+    
+    @staticmethod
+    def _state_query(model):
+        if model == tracker.models.Ticket:
+            return model.objects.values_list('id', 'cluster', 'payment_status').order_by()
+        else:
+            return model.objects.values_list('id', 'cluster', 'amount').order_by()
+    
+    @staticmethod
+    def load_all():
+        """ Loads the complete graph in a fixed number of queries. """
+        graph = ClusterGraph()
+        for model, items in ((tracker.models.Ticket, graph.tickets), (tracker.models.Transaction, graph.transactions)):
+            for item_id, cluster_id, value in ClusterGraph._state_query(model):
+                items[item_id] = (cluster_id, value)
+                if cluster_id is not None:
+                    graph.old_clusters.add(cluster_id)
+        graph.links = set(ClusterGraph._link_model().objects.values_list('ticket', 'transaction').order_by())
+        return graph
+    
+    @staticmethod
+    def load_around(ticket_ids=None, transaction_ids=None):
+        """
+        Loads the part of the graph reachable from given tickets/transactions,
+        including members of their current clusters (which need a refresh as well).
+        Costs a few queries per level of graph distance rather than per item.
+        """
+        graph = ClusterGraph()
+        todo = ClusterGroup(set(ticket_ids or ()), set(transaction_ids or ()))
+        
+        while todo.has_items():
+            found = ClusterGroup()
+            new_clusters = set()
+            for model, ids, items in (
+                    (tracker.models.Ticket, todo.tickets, graph.tickets),
+                    (tracker.models.Transaction, todo.transactions, graph.transactions)):
+                for chunk in chunked(ids):
+                    for item_id, cluster_id, value in ClusterGraph._state_query(model).filter(id__in=chunk):
+                        items[item_id] = (cluster_id, value)
+                        if cluster_id is not None and cluster_id not in graph.old_clusters:
+                            new_clusters.add(cluster_id)
+            graph.old_clusters.update(new_clusters)
+            
+            link_queries = [{'ticket__in': chunk} for chunk in chunked(todo.tickets)]
+            link_queries += [{'transaction__in': chunk} for chunk in chunked(todo.transactions)]
+            for query in link_queries:
+                for link in ClusterGraph._link_model().objects.filter(**query).values_list('ticket', 'transaction').order_by():
+                    graph.links.add(link)
+                    found.tickets.add(link[0])
+                    found.transactions.add(link[1])
+            
+            for chunk in chunked(new_clusters):
+                found.tickets.update(tracker.models.Ticket.objects.filter(cluster__in=chunk).values_list('id', flat=True).order_by())
+                found.transactions.update(tracker.models.Transaction.objects.filter(cluster__in=chunk).values_list('id', flat=True).order_by())
+            
+            seen = ClusterGroup(set(graph.tickets) | todo.tickets, set(graph.transactions) | todo.transactions)
+            todo = ClusterGroup(found.tickets - seen.tickets, found.transactions - seen.transactions)
+        
+        # links to items that vanished in the meantime are of no interest
+        graph.links = set([l for l in graph.links if l[0] in graph.tickets and l[1] in graph.transactions])
+        return graph
+    
+    def _groups(self, stored_clusters=False):
+        uf = UnionFind()
+        for kind, items in (('ticket', self.tickets), ('transaction', self.transactions)):
+            for item_id, (cluster_id, value) in items.items():
+                uf.add((kind, item_id))
+                if stored_clusters and cluster_id is not None:
+                    uf.add(('cluster', cluster_id))
+                    uf.union((kind, item_id), ('cluster', cluster_id))
+        if stored_clusters:
+            # cluster X is the one written by the component of ticket X
+            for ticket_id in self.tickets:
+                if ('cluster', ticket_id) in uf.parent:
+                    uf.union(('ticket', ticket_id), ('cluster', ticket_id))
+        for ticket_id, transaction_id in self.links:
+            uf.union(('ticket', ticket_id), ('transaction', transaction_id))
+        
+        out = []
+        for members in uf.groups():
+            group = ClusterGroup()
+            for kind, item_id in members:
+                if kind == 'ticket':
+                    group.tickets.add(item_id)
+                elif kind == 'transaction':
+                    group.transactions.add(item_id)
+            out.append(group)
+        return out
+    
+    def components(self):
+        """ Returns list of ClusterGroups, one for each connected component. """
+        return self._groups()
+    
+    def partitions(self):
+        """
+        Returns list of ClusterGroups that can be updated independently of each
+        other: connected components, merged when their items currently share
+        a stored cluster, or when one holds items of the stored cluster the
+        other would write (so that each stored cluster is rewritten or deleted
+        by exactly one of them).
+        """
+        return self._groups(stored_clusters=True)
+    
+    def split(self, groups):
+        """ Splits the graph into subgraphs along given disjoint groups (eg. partitions). """
+        out, ticket_graphs = [], {}
+        for group in groups:
+            graph = ClusterGraph()
+            for ticket_id in group.tickets:
+                graph.tickets[ticket_id] = self.tickets[ticket_id]
+                ticket_graphs[ticket_id] = graph
+            for transaction_id in group.transactions:
+                graph.transactions[transaction_id] = self.transactions[transaction_id]
+            for cluster_id, value in graph.tickets.values() + graph.transactions.values():
+                if cluster_id is not None:
+                    graph.old_clusters.add(cluster_id)
+            out.append(graph)
+        for link in self.links:
+            graph = ticket_graphs.get(link[0])
+            if graph is not None and link[1] in graph.transactions:
+                graph.links.add(link)
+        return out
+
+def ticket_totals(ticket_ids):
+    """
+    Returns {ticket_id: accepted expeditures} for given tickets; computed by
+    one grouped query (per chunk of ids) over tickets, their acks and expeditures.
+    """
+    Ticket = tracker.models.Ticket
+    acks = tracker.models.ACCEPTED_ACK_TYPES
+    has_acks = '(select count(distinct ack_type) from tracker_ticketack ack where ack.ticket_id = tracker_ticket.id and ack.ack_type in (%s)) = %d' % (', '.join(['%s'] * len(acks)), len(acks))
+    
+    out = dict([(ticket_id, 0) for ticket_id in ticket_ids])
+    for chunk in chunked(ticket_ids):
+        rows = Ticket.objects.filter(id__in=chunk, rating_percentage__isnull=False).extra(where=[has_acks], params=acks)
+        for row in rows.values('id', 'rating_percentage').annotate(amount=Sum('expediture__amount')).order_by():
+            if row['amount'] is not None:
+                out[row['id']] = row['amount'] * row['rating_percentage'] / 100
+    return out
+
+CLUSTER_TOTAL_PLACES = Decimal('0.01') # matches Cluster.total_* decimal_places
+
+def quantize_total(value):
+    if value is None:
+        return None
+    return Decimal(value).quantize(CLUSTER_TOTAL_PLACES)
+
+def ticket_topics(ticket_ids):
+    """ Returns {ticket_id: topic_id} for given tickets. """
+    out = {}
+    for chunk in chunked(ticket_ids):
+        out.update(tracker.models.Ticket.objects.filter(id__in=chunk).values_list('id', 'topic').order_by())
+    return out
+
+# Cluster fields computed by cluster_fields()
+CLUSTER_FIELDS = ('more_tickets', 'total_tickets', 'total_transactions', 'ticket_count', 'transaction_count', 'topic_count')
+
+def cluster_fields(group, totals, amounts, topics):
+    """
+    Stored Cluster fields of a cluster with given members (ClusterGroup);
+    totals, amounts and topics map its tickets and transactions to accepted
+    expeditures, amounts and topic ids.
+    """
+    transaction_amounts = [amounts[tr] for tr in group.transactions]
+    return {
+        'more_tickets': len(group.tickets) > 1,
+        'total_tickets': quantize_total(sum([totals[t] for t in group.tickets])),
+        'total_transactions': quantize_total(sum(transaction_amounts) if transaction_amounts else None),
+        'ticket_count': len(group.tickets),
+        'transaction_count': len(group.transactions),
+        'topic_count': len(set([topics[t] for t in group.tickets])),
+    }
+
+class ClusterChanges(object):
+    """ Difference between stored cluster state and the freshly computed one. """
+    def __init__(self):
+        self.created_clusters = {} # cluster_id -> field values
+        self.changed_clusters = {} # cluster_id -> changed field values
+        self.stale_clusters = set() # cluster ids to delete
+        self.ticket_moves = {} # new cluster_id -> set of ticket ids
+        self.transaction_moves = {} # new cluster_id (or None) -> set of transaction ids
+        self.ticket_statuses = {} # new payment_status -> set of ticket ids
+        self.tickets = set() # all the tickets whose clusters were recomputed
+    
+    def is_empty(self):
+        return not (self.created_clusters or self.changed_clusters or self.stale_clusters
+            or self.ticket_moves or self.transaction_moves or self.ticket_statuses)
+
 class ClusterUpdate(object):
     """ This holds all the context for cluster associations update. """
     
-    def _reset_item_cluster(self, item):
-        """
-        Takes cluster-item (Ticket or Transaction), destroy its cluster, and queue
-        all its members for update in big_todo (unless they already are in big_done).
-        """
-        try:
-            cluster = item.cluster
-        except tracker.models.Cluster.DoesNotExist:
-            return # reference failure from earlier delete, we'll fix that later
-        
-        if cluster == None:
-            return # done all right
-        
-        for ticket in cluster.ticket_set.all():
-            if ticket.id not in self.big_done.tickets:
-                self.big_todo.tickets.add(ticket.id)
-        
-        for transaction in cluster.transaction_set.all():
-            if transaction.id not in self.big_done.transactions:
-                self.big_todo.transactions.add(transaction.id)
-        
-        cluster.delete()
-    
-    def _make_one_cluster(self, seed):
-        """ Make one cluster from seed item, updating the "big picture" """
-        
-        # this will be already 'processed' seed items
-        precluster = ClusterGroup()
-        
-        while seed.has_items():
-            if seed.has_tickets():
-                ticket_id = seed.tickets.pop()
-                ticket = tracker.models.Ticket.objects.get(id=ticket_id)
-                for transaction in ticket.transaction_set.all():
-                    if transaction.id not in precluster.transactions:
-                        seed.transactions.add(transaction.id)
-                        self.big_todo.transactions.discard(transaction.id)
-                precluster.tickets.add(ticket_id)
-            else: # there must be a transaction
-                transaction_id = seed.transactions.pop()
-                transaction = tracker.models.Transaction.objects.get(id=transaction_id)
-                for ticket in transaction.tickets.all():
-                    if ticket.id not in precluster.tickets:
-                        seed.tickets.add(ticket.id)
-                        self.big_todo.tickets.discard(ticket.id)
-                precluster.transactions.add(transaction_id)
-        
-        # we have a completed cluster
-        self.big_done.update(precluster) # our items are now considered done in the big scheme
-        
-        # clean up existing members
-        for ticket in tracker.models.Ticket.objects.in_bulk(precluster.tickets).itervalues():
-            self._reset_item_cluster(ticket)
-        for transaction in tracker.models.Transaction.objects.in_bulk(precluster.transactions).itervalues():
-            self._reset_item_cluster(transaction)
-        
-        if len(precluster.tickets) == 0:
-            return # no tickets -> no cluster; leave transaction clusterless
-        
-        c = tracker.models.Cluster(id=min(precluster.tickets), more_tickets=(len(precluster.tickets)>1))
-        c.save()
-        for ti in tracker.models.Ticket.objects.in_bulk(precluster.tickets).itervalues():
-            ti.cluster = c
-            ti.save(cluster_update_only=True)
-        for tr in tracker.models.Transaction.objects.in_bulk(precluster.transactions).itervalues():
-            tr.cluster = c
-            tr.save(cluster_update_only=True)
-        c.update_status()
-
+    def __init__(self, graph):
+        self.graph = graph
+    
+    def plan(self):
+        """ Compares computed clusters with the stored ones and returns ClusterChanges. """
+        graph = self.graph
+        changes = ClusterChanges()
+        changes.tickets = set(graph.tickets)
+        components = graph.components()
+        
+        new_ids = set([min(group.tickets) for group in components if group.has_tickets()])
+        stored = {}
+        for chunk in chunked(new_ids | graph.old_clusters):
+            for row in tracker.models.Cluster.objects.filter(id__in=chunk).values('id', *CLUSTER_FIELDS):
+                stored[row.pop('id')] = row
+        
+        ticket_ids = set().union(*[group.tickets for group in components])
+        totals, topics = ticket_totals(ticket_ids), ticket_topics(ticket_ids)
+        amounts = dict([(transaction_id, amount) for transaction_id, (cluster_id, amount) in graph.transactions.items()])
+        for group in components:
+            if group.has_tickets():
+                cluster_id = min(group.tickets)
+                fields = cluster_fields(group, totals, amounts, topics)
+                if cluster_id not in stored:
+                    changes.created_clusters[cluster_id] = fields
+                else:
+                    changed = dict([(k, v) for k, v in fields.items() if stored[cluster_id][k] != v])
+                    if changed:
+                        changes.changed_clusters[cluster_id] = changed
+                status = tracker.models.Cluster(**fields).get_status()
+            else:
+                cluster_id = None # no tickets -> no cluster; leave transaction clusterless
+            
+            for ticket_id in group.tickets:
+                old_cluster_id, old_status = graph.tickets[ticket_id]
+                if old_cluster_id != cluster_id:
+                    changes.ticket_moves.setdefault(cluster_id, set()).add(ticket_id)
+                if old_status != status:
+                    changes.ticket_statuses.setdefault(status, set()).add(ticket_id)
+            for transaction_id in group.transactions:
+                if graph.transactions[transaction_id][0] != cluster_id:
+                    changes.transaction_moves.setdefault(cluster_id, set()).add(transaction_id)
+        
+        changes.stale_clusters = graph.old_clusters - new_ids
+        return changes
+    
+    def apply(self, changes):
+        """ Writes ClusterChanges using set-based updates. """
+        Cluster, Ticket, Transaction = tracker.models.Cluster, tracker.models.Ticket, tracker.models.Transaction
+        
+        for cluster_id, fields in changes.created_clusters.items():
+            Cluster.objects.create(id=cluster_id, **fields)
+        for cluster_id, fields in changes.changed_clusters.items():
+            Cluster.objects.filter(id=cluster_id).update(**fields)
+        
+        for model, moves in ((Ticket, changes.ticket_moves), (Transaction, changes.transaction_moves)):
+            for cluster_id, ids in moves.items():
+                for chunk in chunked(ids):
+                    model.objects.filter(id__in=chunk).update(cluster=cluster_id)
+        for status, ids in changes.ticket_statuses.items():
+            for chunk in chunked(ids):
+                Ticket.objects.filter(id__in=chunk).update(payment_status=status, row_version=F('row_version') + 1)
+        
+        # nothing refers to stale clusters any more
+        for chunk in chunked(changes.stale_clusters):
+            Cluster.objects.filter(id__in=chunk).delete()
+    
+    def run(self):
+        changes = self.plan()
+        self.apply(changes)
+        if not changes.is_empty():
+            clusters_updated.send(sender=ClusterUpdate, changes=changes)
+        return changes
+    
     @staticmethod
     def perform(ticket_ids=None, transaction_ids=None):
-        """ Performs a propagating cluster update for mentioned tickets/transactions. """
-        update = ClusterUpdate()
-        update.big_todo = ClusterGroup(tickets=ticket_ids, transactions=transaction_ids)
-        update.big_done = ClusterGroup()
-        
-        while update.big_todo.has_items():
-            seed = ClusterGroup()
-            if update.big_todo.has_tickets():
-                seed.tickets.add(update.big_todo.tickets.pop())
-            else: # transactions
-                seed.transactions.add(update.big_todo.transactions.pop())
-            update._make_one_cluster(seed)
+        """
+        Performs a propagating cluster update for mentioned tickets/transactions.
+        Inside a batch (see coalesced_updates), the ids are only noted down
+        and None is returned.
+        """
+        if _batch.depth > 0:
+            _batch.group.update(ClusterGroup(set(ticket_ids or ()), set(transaction_ids or ())))
+            return None
+        if getattr(settings, 'TRACKER_CLUSTER_UPDATE_QUEUE', False):
+            ClusterUpdate.enqueue(ticket_ids, transaction_ids)
+            return None
+        return ClusterUpdate.perform_now(ticket_ids, transaction_ids)
+    
+    @staticmethod
+    def perform_now(ticket_ids=None, transaction_ids=None):
+        """ Performs the update right away, regardless of batching and queueing. """
+        return ClusterUpdate(ClusterGraph.load_around(ticket_ids, transaction_ids)).run()
+    
+    @staticmethod
+    def enqueue(ticket_ids=None, transaction_ids=None):
+        """
+        Queues the update for the process_cluster_updates command and flags
+        all the tickets it may concern as pending.
+        """
+        Ticket, Transaction, Job = tracker.models.Ticket, tracker.models.Transaction, tracker.models.ClusterUpdateJob
+        ticket_ids, transaction_ids = set(ticket_ids or ()), set(transaction_ids or ())
+        for ticket_id in ticket_ids:
+            Job.objects.create(ticket_id=ticket_id)
+        for transaction_id in transaction_ids:
+            Job.objects.create(transaction_id=transaction_id)
+        
+        for ticket_chunk in chunked(ticket_ids):
+            cluster_ids = Ticket.objects.filter(id__in=ticket_chunk, cluster__isnull=False).values('cluster')
+            Ticket.objects.filter(Q(id__in=ticket_chunk) | Q(cluster__in=cluster_ids)).update(cluster_update_pending=True, row_version=F('row_version') + 1)
+        for transaction_chunk in chunked(transaction_ids):
+            cluster_ids = Transaction.objects.filter(id__in=transaction_chunk, cluster__isnull=False).values('cluster')
+            Ticket.objects.filter(Q(transaction__in=transaction_chunk) | Q(cluster__in=cluster_ids)).update(cluster_update_pending=True, row_version=F('row_version') + 1)
+    
+    @staticmethod
+    def ticket_total(ticket_id):
+        """
+        Accepted expeditures of the ticket as stored now; to be called before
+        a change and passed to ticket_total_changed afterwards. Inside a batch
+        the total from before its first change is kept; returns None when
+        updates are queued, as deltas are of no use then.
+        """
+        if getattr(settings, 'TRACKER_CLUSTER_UPDATE_QUEUE', False):
+            return None
+        if _batch.depth > 0 and ticket_id in _batch.old_totals:
+            return _batch.old_totals[ticket_id]
+        return ticket_totals([ticket_id])[ticket_id]
+    
+    @staticmethod
+    def ticket_total_changed(ticket_id, old_total):
+        """
+        Updates cluster totals and payment statuses after accepted expeditures
+        of a ticket (may have) changed from old_total. Inside a batch, the old
+        total is only noted down and the difference applied at its end.
+        """
+        if old_total is None:
+            return ClusterUpdate.perform(ticket_ids=set([ticket_id]))
+        if _batch.depth > 0:
+            _batch.old_totals.setdefault(ticket_id, old_total)
+            return None
+        return ClusterUpdate.totals_changed({ticket_id: old_total})
+    
+    @staticmethod
+    def totals_changed(old_totals):
+        """
+        Applies the differences between current accepted expeditures of tickets
+        and given {ticket_id: old_total} to their clusters, summed per cluster.
+        Falls back to perform_now() for tickets with no cluster yet, and for
+        clusters whose summed difference can't be stored exactly.
+        """
+        Ticket, Cluster = tracker.models.Ticket, tracker.models.Cluster
+        ticket_clusters = {}
+        for chunk in chunked(old_totals):
+            ticket_clusters.update(Ticket.objects.filter(id__in=chunk).values_list('id', 'cluster').order_by())
+        new_totals = ticket_totals(old_totals.keys())
+        
+        fallback, deltas, cluster_tickets = set(), {}, {}
+        for ticket_id, old_total in old_totals.items():
+            cluster_id = ticket_clusters.get(ticket_id)
+            if cluster_id is None:
+                fallback.add(ticket_id)
+                continue
+            deltas[cluster_id] = deltas.get(cluster_id, 0) + new_totals[ticket_id] - old_total
+            cluster_tickets.setdefault(cluster_id, set()).add(ticket_id)
+        
+        changes = ClusterChanges()
+        updated = set()
+        for cluster_id, delta in sorted(deltas.items()):
+            if delta == 0:
+                continue
+            # the stored total is the rounded sum of exact ticket totals, so
+            # only an exact difference keeps it equal to a full recount
+            if quantize_total(delta) != delta or not Cluster.objects.filter(id=cluster_id, total_tickets__isnull=False).update(total_tickets=F('total_tickets') + delta):
+                fallback.update(cluster_tickets[cluster_id])
+                continue
+            updated.add(cluster_id)
+        
+        for chunk in chunked(updated):
+            changes.tickets.update(Ticket.objects.filter(cluster__in=chunk).values_list('id', flat=True))
+            for cluster in Cluster.objects.filter(id__in=chunk):
+                changes.changed_clusters[cluster.id] = {'total_tickets': cluster.total_tickets}
+                status = cluster.get_status()
+                changed_tickets = set(Ticket.objects.filter(cluster=cluster.id).exclude(payment_status=status).values_list('id', flat=True))
+                if changed_tickets:
+                    Ticket.objects.filter(id__in=changed_tickets).update(payment_status=status, row_version=F('row_version') + 1)
+                    changes.ticket_statuses.setdefault(status, set()).update(changed_tickets)
+        if not changes.is_empty():
+            clusters_updated.send(sender=ClusterUpdate, changes=changes)
+        if fallback:
+            ClusterUpdate.perform_now(ticket_ids=fallback)
+        return changes
+    
+    @staticmethod
+    def process_queue(batch_size=CHUNK_SIZE):
+        """
+        Takes up to batch_size oldest queued jobs, performs a single update
+        for all of them and removes them from the queue. Returns the number
+        of jobs processed (zero means the queue is empty).
+        """
+        Ticket, Job = tracker.models.Ticket, tracker.models.ClusterUpdateJob
+        jobs = list(Job.objects.order_by('id').values_list('id', 'ticket_id', 'transaction_id')[:batch_size])
+        if not jobs:
+            return 0
+        
+        group = ClusterGroup()
+        for job_id, ticket_id, transaction_id in jobs:
+            if ticket_id is not None:
+                group.tickets.add(ticket_id)
+            if transaction_id is not None:
+                group.transactions.add(transaction_id)
+        
+        with transaction.commit_on_success():
+            changes = ClusterUpdate.perform_now(group.tickets, group.transactions)
+            for chunk in chunked([job[0] for job in jobs]):
+                Job.objects.filter(id__in=chunk).delete()
+            
+            # tickets queued again in the meantime stay pending
+            queued_tickets = Job.objects.filter(ticket_id__isnull=False).values('ticket_id')
+            queued_transactions = Job.objects.filter(transaction_id__isnull=False).values('transaction_id')
+            for chunk in chunked(changes.tickets):
+                Ticket.objects.filter(id__in=chunk, cluster_update_pending=True).exclude(
+                    id__in=queued_tickets).exclude(transaction__in=queued_transactions).update(cluster_update_pending=False, row_version=F('row_version') + 1)
+        return len(jobs)
     
     @staticmethod
     def refresh_all():
-        ticket_ids = set([t.id for t in tracker.models.Ticket.objects.all().only('id')])
-        transaction_ids = set([t.id for t in tracker.models.Transaction.objects.all().only('id')])
-        ClusterUpdate.perform(ticket_ids, transaction_ids)
+        return ClusterUpdate(ClusterGraph.load_all()).run()
+
+def check_clusters(chunk_size=CHUNK_SIZE):
+    """
+    Verifies stored clusters and payment statuses against the payment links,
+    reading clusters, tickets and transactions in id-ordered chunks. Yields
+    a dict for each discrepancy: 'check' name, ids of the items concerned,
+    'expected' and 'found' values where applicable and 'repair', the tickets
+    and transactions to pass to ClusterUpdate.perform to fix it.
+    """
+    Ticket, Transaction, Cluster = tracker.models.Ticket, tracker.models.Transaction, tracker.models.Cluster
+    Link = ClusterGraph._link_model()
+    
+    def discrepancy(check, tickets=(), transactions=(), **values):
+        values.update({'check': check, 'repair': {'tickets': sorted(tickets), 'transactions': sorted(transactions)}})
+        return values
+    
+    last = None
+    while True:
+        clusters = Cluster.objects.order_by('id').values('id', *CLUSTER_FIELDS)
+        if last is not None:
+            clusters = clusters.filter(id__gt=last)
+        clusters = list(clusters[:chunk_size])
+        if not clusters:
+            break
+        ids = [c['id'] for c in clusters]
+        last = ids[-1]
+        
+        members = dict([(cluster_id, ClusterGroup()) for cluster_id in ids])
+        statuses, amounts, topics = {}, {}, {}
+        for ticket_id, cluster_id, status, topic_id in Ticket.objects.filter(cluster__in=ids).values_list('id', 'cluster', 'payment_status', 'topic').order_by():
+            members[cluster_id].tickets.add(ticket_id)
+            statuses[ticket_id] = status
+            topics[ticket_id] = topic_id
+        for transaction_id, cluster_id, amount in Transaction.objects.filter(cluster__in=ids).values_list('id', 'cluster', 'amount').order_by():
+            members[cluster_id].transactions.add(transaction_id)
+            amounts[transaction_id] = amount
+        
+        # linked items have to share the cluster, and each cluster has to be connected
+        uf = UnionFind()
+        for ticket_id, transaction_id, ticket_cluster, transaction_cluster in Link.objects.filter(
+                ticket__cluster__in=ids).values_list('ticket', 'transaction', 'ticket__cluster', 'transaction__cluster').order_by():
+            if ticket_cluster != transaction_cluster:
+                yield discrepancy('link_across_clusters', [ticket_id], [transaction_id], ticket=ticket_id, transaction=transaction_id,
+                    expected=ticket_cluster, found=transaction_cluster)
+            else:
+                uf.add(('ticket', ticket_id))
+                uf.add(('transaction', transaction_id))
+                uf.union(('ticket', ticket_id), ('transaction', transaction_id))
+        
+        totals = ticket_totals(statuses.keys())
+        for stored in clusters:
+            cluster_id = stored.pop('id')
+            group = members[cluster_id]
+            if not group.has_tickets():
+                yield discrepancy('no_tickets', transactions=group.transactions, cluster=cluster_id)
+                continue
+            repair = [min(group.tickets)]
+            if repair[0] != cluster_id:
+                yield discrepancy('cluster_id', repair, cluster=cluster_id, expected=repair[0], found=cluster_id)
+            
+            fields = cluster_fields(group, totals, amounts, topics)
+            for field in sorted(fields):
+                if fields[field] != stored[field]:
+                    yield discrepancy(field, repair, cluster=cluster_id, expected=fields[field], found=stored[field])
+            
+            status = Cluster(**fields).get_status()
+            for ticket_id in sorted(group.tickets):
+                if statuses[ticket_id] != status:
+                    yield discrepancy('payment_status', [ticket_id], cluster=cluster_id, ticket=ticket_id, expected=status, found=statuses[ticket_id])
+            
+            roots = set()
+            for kind, items in (('ticket', group.tickets), ('transaction', group.transactions)):
+                for item_id in items:
+                    uf.add((kind, item_id))
+                    roots.add(uf.find((kind, item_id)))
+            if len(roots) > 1:
+                yield discrepancy('not_connected', group.tickets, group.transactions, cluster=cluster_id, found=len(roots))
+    
+    # every ticket has a cluster, and so has every linked transaction; and
+    # no ticket or transaction refers to a cluster that does not exist
+    existing = Cluster.objects.values('id')
+    for kind, model in (('ticket', Ticket), ('transaction', Transaction)):
+        no_cluster = model.objects.filter(cluster__isnull=True)
+        if kind == 'transaction':
+            no_cluster = no_cluster.filter(tickets__isnull=False)
+        dangling = model.objects.filter(cluster__isnull=False).exclude(cluster__in=existing)
+        for check, items in (('no_cluster', no_cluster), ('dangling_cluster', dangling)):
+            last = None
+            while True:
+                chunk = items.order_by('id').values_list('id', 'cluster').distinct()
+                if last is not None:
+                    chunk = chunk.filter(id__gt=last)
+                chunk = list(chunk[:chunk_size])
+                if not chunk:
+                    break
+                last = chunk[-1][0]
+                for item_id, cluster_id in chunk:
+                    values = {kind: item_id}
+                    if cluster_id is not None:
+                        values['found'] = cluster_id
+                    if kind == 'ticket':
+                        yield discrepancy(check, [item_id], **values)
+                    else:
+                        yield discrepancy(check, transactions=[item_id], **values)
+
+class _PendingBatch(threading.local):
+    """ Per-thread collection of ids waiting for a coalesced ClusterUpdate. """
+    def __init__(self):
+        self.depth = 0
+        self.group = None
+        self.old_totals = {} # ticket_id -> accepted expeditures before the batch
+_batch = _PendingBatch()
+
+def begin_batch():
+    """ Starts (or joins) a batch collecting ClusterUpdate.perform calls. """
+    if _batch.depth == 0:
+        _batch.group = ClusterGroup()
+        _batch.old_totals = {}
+    _batch.depth += 1
+
+def end_batch(discard=False):
+    """
+    Leaves a batch; the outermost one applies the collected ticket total
+    differences and performs a single update over everything else collected
+    (unless told to discard it all).
+    """
+    if _batch.depth == 0:
+        return None # never started, eg. a request middleware short-circuited
+    _batch.depth -= 1
+    if _batch.depth > 0:
+        return None
+    group, _batch.group = _batch.group, None
+    old_totals, _batch.old_totals = _batch.old_totals, {}
+    if discard:
+        return None
+    for ticket_id in group.tickets: # recounted in full anyway
+        old_totals.pop(ticket_id, None)
+    # differences go to the clusters as stored, before any regrouping
+    if old_totals:
+        ClusterUpdate.totals_changed(old_totals)
+    if not group.has_items():
+        return None
+    return ClusterUpdate.perform(group.tickets, group.transactions)
+
+def flush_batch():
+    """ Closes the batch however deep it is, performing the collected update. """
+    if _batch.depth == 0:
+        return None
+    _batch.depth = 1
+    return end_batch()
+
+@contextmanager
+def coalesced_updates():
+    """
+    Runs one ClusterUpdate for all the changes in the block. Meant to be
+    nested inside `transaction.commit_on_success`, so that the update is
+    committed together with the changes; on exception the collected ids are
+    dropped along with the rolled back changes.
+    """
+    begin_batch()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        end_batch(discard=not succeeded)
@@ -1,27 +1,68 @@
 # -*- coding: utf-8 -*-
+import datetime
+import hashlib
+
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.contrib.syndication.views import Feed
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.http import condition
+
+from tracker.models import Topic, Ticket, Transaction, feed_version
+from tracker.views import TicketFilterForm
 
-from tracker.models import Topic, Ticket, Transaction
+class CachedFeed(Feed):
+    """
+    Feed rendered once per feed_version() of its kind and per URL; the
+    version is its Last-Modified time too.
+    """
+    kind = 'tickets'
+    
+    def cache_key(self, request):
+        variant = (request.get_host(), request.is_secure(), request.get_full_path(), translation.get_language())
+        return 'tracker:feed:%s:%r:%s' % (self.__class__.__name__, feed_version(self.kind), hashlib.md5(repr(variant)).hexdigest())
+    
+    def etag(self, request, *args, **kwargs):
+        return hashlib.md5(self.cache_key(request)).hexdigest()
+    
+    def last_modified(self, request, *args, **kwargs):
+        return datetime.datetime.utcfromtimestamp(int(feed_version(self.kind)))
+    
+    def __call__(self, request, *args, **kwargs):
+        return condition(etag_func=self.etag, last_modified_func=self.last_modified)(self.render)(request, *args, **kwargs)
+    
+    def render(self, request, *args, **kwargs):
+        key = self.cache_key(request)
+        cached = cache.get(key)
+        if cached is None:
+            response = super(CachedFeed, self).__call__(request, *args, **kwargs)
+            cached = (response['Content-Type'], response.content)
+            cache.set(key, cached)
+        return HttpResponse(cached[1], content_type=cached[0])
 
-class LatestTicketsFeed(Feed):
+class LatestTicketsFeed(CachedFeed):
     description_template = 'feeds/ticket_description.html'
     title = _('Latest tickets')
     description = _('Recently changed tickets')
-
-    def link(self):
-        return reverse('ticket_list')
     
-    def items(self):
-        return Ticket.objects.order_by('-updated')[:10]
+    def get_object(self, request):
+        return TicketFilterForm(request.GET)
+    
+    def link(self, filter_form):
+        query = filter_form.data.urlencode()
+        return reverse('ticket_list') + (query and '?' + query)
+    
+    def items(self, filter_form):
+        return filter_form.filter(Ticket.objects.select_related('topic__grant', 'requested_user')).order_by('-updated')[:10]
     
     def item_pubdate(self, item):
         return item.updated
 
 
-class TopicTicketsFeed(Feed):
+class TopicTicketsFeed(CachedFeed):
     description_template = 'feeds/ticket_description.html'
     
     def get_object(self, request, pk):
@@ -34,21 +75,24 @@ class TopicTicketsFeed(Feed):
         return topic.get_absolute_url()
     
     def items(self, topic):
-        return topic.ticket_set.order_by('-updated')[:10]
+        return topic.ticket_set.select_related('topic__grant', 'requested_user').order_by('-updated')[:10]
     
     def item_pubdate(self, item):
         return item.updated
 
-class TransactionsFeed(Feed):
+class TransactionsFeed(CachedFeed):
     description_template = 'feeds/transaction_description.html'
+    kind = 'transactions'
     
     def link(self):
         return reverse('transaction_list')
     
     def items(self):
-        return Transaction.objects.order_by('-date')[:10]
+        return Transaction.objects.select_related('other').order_by('-date')[:10]
     
     def item_link(self, item):
+        if item.other is None:
+            return reverse('transaction_list')
         return item.other.get_absolute_url()
     
     def item_guid(self, item):
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tracker.models import FinanceSnapshot
+
+def describe_key(key):
+    topic_id, grant_id = key
+    if topic_id is not None:
+        return 'topic %d' % topic_id
+    elif grant_id is not None:
+        return 'grant %d' % grant_id
+    return 'total'
+
+class Command(NoArgsCommand):
+    help = 'Compares the stored finance snapshot with finances computed from the tickets now; optionally rebuilds it.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Throw the stored snapshot away and build it again from scratch'),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['rebuild']:
+            FinanceSnapshot.objects.all().delete()
+            FinanceSnapshot.refresh()
+        
+        computed = FinanceSnapshot.compute()
+        stored = dict([((row.topic_id, row.grant_id), row.values()) for row in FinanceSnapshot.objects.all()])
+        differences = 0
+        for key in sorted(set(computed) | set(stored)):
+            if key not in stored:
+                self.stdout.write('%s: missing\n' % describe_key(key))
+            elif key not in computed:
+                self.stdout.write('%s: stale\n' % describe_key(key))
+            else:
+                changed = [name for name in FinanceSnapshot.FIELDS if stored[key][name] != computed[key][name]]
+                if not changed:
+                    continue
+                self.stdout.write('%s: %s\n' % (describe_key(key), ', '.join(['%s %s != %s' % (name, stored[key][name], computed[key][name]) for name in changed])))
+            differences += 1
+        
+        if verbosity > 0:
+            sys.stderr.write('%d differences found\n' % differences)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tracker.clusters import ClusterUpdate, CHUNK_SIZE
+
+class Command(NoArgsCommand):
+    help = 'Processes cluster updates queued while TRACKER_CLUSTER_UPDATE_QUEUE is on.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=CHUNK_SIZE,
+            help='Number of queued jobs merged into a single update (default %d)' % CHUNK_SIZE),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running and wait for new jobs instead of exiting once the queue is empty'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+            help='Seconds to wait between polls of an empty queue in --loop mode (default 5)'),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            processed = ClusterUpdate.process_queue(options['batch_size'])
+            if processed > 0:
+                if verbosity > 1:
+                    self.stdout.write('Processed %d queued updates\n' % processed)
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
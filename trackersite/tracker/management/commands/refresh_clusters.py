@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import itertools
+import multiprocessing
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+
+from tracker.clusters import ClusterGraph, ClusterGroup, ClusterUpdate, CHUNK_SIZE
+from tracker.models import FinanceSnapshot, feed_changed
+
+def partition_key(group):
+    """ Identifies a partition by its members in the checkpoint file. """
+    return hashlib.md5(repr((sorted(group.tickets), sorted(group.transactions)))).hexdigest()
+
+def format_fields(fields):
+    return ', '.join(['%s=%s' % (name, fields[name]) for name in sorted(fields)])
+
+def describe_changes(graph, changes):
+    """ Returns human readable lines describing ClusterChanges of given graph. """
+    lines = []
+    for cluster_id, fields in sorted(changes.created_clusters.items()):
+        lines.append('cluster %d: create (%s)' % (cluster_id, format_fields(fields)))
+    for cluster_id, fields in sorted(changes.changed_clusters.items()):
+        lines.append('cluster %d: update (%s)' % (cluster_id, format_fields(fields)))
+    for cluster_id in sorted(changes.stale_clusters):
+        lines.append('cluster %d: delete' % cluster_id)
+    for cluster_id, ticket_ids in sorted(changes.ticket_moves.items()):
+        for ticket_id in sorted(ticket_ids):
+            lines.append('ticket %d: cluster %s -> %s' % (ticket_id, graph.tickets[ticket_id][0], cluster_id))
+    for status, ticket_ids in sorted(changes.ticket_statuses.items()):
+        for ticket_id in sorted(ticket_ids):
+            lines.append('ticket %d: payment status %s -> %s' % (ticket_id, graph.tickets[ticket_id][1], status))
+    return lines
+
+def refresh_part(args):
+    """ Updates (or just plans the update of) one part of the graph; runs in worker processes. """
+    index, graph, dry_run = args
+    update = ClusterUpdate(graph)
+    changes = update.plan()
+    if not dry_run:
+        # not run(), parts would refresh the finance snapshot concurrently; it is rebuilt once at the end
+        with transaction.commit_on_success():
+            update.apply(changes)
+    return index, describe_changes(graph, changes)
+
+class Command(NoArgsCommand):
+    help = 'Recomputes all clusters and ticket payment statuses, in parallel and resumably.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=1,
+            help='Number of worker processes (default 1, ie. no pool)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=CHUNK_SIZE,
+            help='Approximate number of tickets and transactions updated in one transaction (default %d)' % CHUNK_SIZE),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File noting finished partitions; an interrupted run given the same file resumes where it stopped'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only print the clusters and payment statuses that would change'),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        processes, batch_size = options['processes'], options['batch_size']
+        checkpoint, dry_run = options['checkpoint'], options['dry_run']
+        if processes < 1 or batch_size < 1:
+            raise CommandError('--processes and --batch-size have to be positive')
+        
+        started = time.time()
+        graph = ClusterGraph.load_all()
+        done = set()
+        if checkpoint and os.path.exists(checkpoint):
+            done = set(open(checkpoint).read().split())
+        
+        # merge small partitions into parts of about batch_size items
+        parts, part, part_keys, skipped = [], ClusterGroup(), [], 0
+        partitions = sorted(graph.partitions(), key=lambda group: (min(group.tickets or [None]), min(group.transactions or [None])))
+        for group in partitions:
+            key = partition_key(group)
+            if key in done:
+                skipped += len(group.tickets)
+                continue
+            part.update(group)
+            part_keys.append(key)
+            if len(part.tickets) + len(part.transactions) >= batch_size:
+                parts.append((part, part_keys))
+                part, part_keys = ClusterGroup(), []
+        if part.has_items():
+            parts.append((part, part_keys))
+        
+        subgraphs = graph.split([group for group, keys in parts])
+        tasks = [(index, subgraph, dry_run) for index, subgraph in enumerate(subgraphs)]
+        if verbosity > 0:
+            self.stdout.write('Loaded %d tickets and %d transactions in %.1fs, %d tickets already done; %d parts to go\n' % (
+                len(graph.tickets), len(graph.transactions), time.time() - started, skipped, len(tasks)))
+        
+        pool = None
+        if processes > 1 and len(tasks) > 1:
+            connection.close() # workers have to open connections of their own
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(refresh_part, tasks)
+        else:
+            results = itertools.imap(refresh_part, tasks)
+        
+        started, tickets, changed = time.time(), 0, 0
+        try:
+            for finished, (index, lines) in enumerate(results):
+                if lines and (dry_run or verbosity > 1):
+                    self.stdout.write(''.join([line + '\n' for line in lines]))
+                if checkpoint and not dry_run:
+                    out = open(checkpoint, 'a')
+                    out.write(''.join([key + '\n' for key in parts[index][1]]))
+                    out.close()
+                tickets += len(subgraphs[index].tickets)
+                changed += len(lines)
+                if verbosity > 0:
+                    elapsed = time.time() - started
+                    self.stdout.write('%d/%d parts, %d tickets, %.0f tickets/s\n' % (
+                        finished + 1, len(tasks), tickets, tickets / elapsed if elapsed else 0))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        
+        # even with nothing changed by this run, a resumed one may have been
+        # preceded by changes of the interrupted one
+        if not dry_run:
+            FinanceSnapshot.refresh()
+            feed_changed('tickets')
+        
+        # a finished run starts over next time
+        if checkpoint and not dry_run and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if verbosity > 0:
+            self.stdout.write('%s %d changes in %.1fs\n' % ('Would make' if dry_run else 'Made', changed, time.time() - started))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from tracker.clusters import check_clusters, CHUNK_SIZE
+
+class Command(NoArgsCommand):
+    help = 'Checks clusters and payment statuses without changing anything; prints one JSON object per discrepancy.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=CHUNK_SIZE,
+            help='Number of clusters read at once (default %d)' % CHUNK_SIZE),
+        make_option('--repair-list', dest='repair_list', default=None,
+            help='File to write "ticket <id>" and "transaction <id>" lines to; updating clusters of those items fixes the discrepancies'),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size has to be positive')
+        repair_list = None
+        if options['repair_list']:
+            repair_list = open(options['repair_list'], 'w')
+        
+        found = 0
+        try:
+            for discrepancy in check_clusters(options['chunk_size']):
+                found += 1
+                self.stdout.write(json.dumps(discrepancy, sort_keys=True, default=unicode) + '\n')
+                if repair_list is not None:
+                    for kind in ('ticket', 'transaction'):
+                        for item_id in discrepancy['repair'][kind + 's']:
+                            repair_list.write('%s %d\n' % (kind, item_id))
+        finally:
+            if repair_list is not None:
+                repair_list.close()
+        
+        if verbosity > 0:
+            sys.stderr.write('%d discrepancies found\n' % found)
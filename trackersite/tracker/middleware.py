@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from tracker.clusters import begin_batch, end_batch, flush_batch
+
+class ClusterUpdateMiddleware(object):
+    """
+    Coalesces all cluster updates triggered during a request into a single
+    one, performed when the response is ready. The update of a request that
+    failed with an exception is dropped, as are its rolled back changes.
+    """
+    def process_request(self, request):
+        # a batch still open here was left by a request that never got its
+        # response processed; its changes are saved, so update for them now
+        flush_batch()
+        begin_batch()
+    
+    def process_exception(self, request, exception):
+        end_batch(discard=True)
+        return None
+    
+    def process_response(self, request, response):
+        end_batch()
+        return response
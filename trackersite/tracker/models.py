@@ -1,21 +1,24 @@
 # -*- coding: utf-8 -*-
 import datetime
+import time
+from decimal import Decimal
 
 from django.contrib.comments.signals import comment_was_posted
 from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from django.db import models
+from django.db import models, connection
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _, string_concat
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
+from django.core.cache import cache
 from django import template
 from south.modelsinspector import add_introspection_rules
 
-from tracker.clusters import ClusterUpdate
+from tracker.clusters import ClusterUpdate, ClusterGroup, chunked, quantize_total, clusters_updated
 
 PAYMENT_STATUS_CHOICES = (
     ('n_a', _('n/a')),
@@ -36,6 +39,99 @@ ACK_TYPES = (
 
 USER_EDITABLE_ACK_TYPES = ('user_content', 'user_docs')
 
+TRANSACTION_TOTAL_CACHE_KEY = 'tracker:transaction_total'
+TOPIC_FORM_DATA_CACHE_KEY = 'tracker:topic_form_data'
+FEED_VERSION_CACHE_KEY = 'tracker:feed_version'
+# for cached versions and data that are replaced whenever they change rather
+# than left to expire; 30 days is the longest timeout memcached takes as relative
+VERSIONED_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+# bits of Ticket.ack_mask; stored in the database, so new ack types go to the end of ACK_TYPES
+ACK_BITS = dict([(ack_type, 1 << i) for i, (ack_type, display) in enumerate(ACK_TYPES)])
+
+def ack_types_mask(ack_types):
+    """ Returns Ticket.ack_mask value for given ack types. """
+    mask = 0
+    for ack_type in ack_types:
+        mask |= ACK_BITS[ack_type]
+    return mask
+
+TICKET_STATES = (
+    ('draft', _('draft')),
+    ('waiting_for_approval', _('waiting for approval')),
+    ('waiting_for_rating', _('waiting for content rating')),
+    ('waiting_for_documents', _('waiting for document submission')),
+    ('waiting_for_filing', _('waiting for filing of documents')),
+    ('complete', _('complete')),
+    ('archived', _('archived')),
+    ('closed', _('closed')),
+    ('custom', _('custom state')),
+)
+
+def ticket_state(custom_state, ack_mask, rating_percentage):
+    """ Computes Ticket.state from the fields it depends on. """
+    def has(ack_type):
+        return ack_mask & ACK_BITS[ack_type]
+    
+    if custom_state:
+        return 'custom'
+    elif has('close'):
+        # the computed state_str() this replaced looked for a 'closed' ack,
+        # which does not exist, so closed tickets used to show the state
+        # of their other acks; the 'close' ack now wins over all of them
+        return 'closed'
+    elif has('archive'):
+        return 'archived'
+    elif has('content'):
+        if not rating_percentage:
+            return 'waiting_for_rating'
+        elif has('docs'):
+            return 'complete'
+        elif has('user_docs'):
+            return 'waiting_for_filing'
+        else:
+            return 'waiting_for_documents'
+    elif has('user_content'):
+        return 'waiting_for_approval'
+    else:
+        return 'draft'
+
+# correlated subqueries added by TicketQuerySet.with_summaries
+TICKET_SUMMARIES = {
+    'summary_media_objects': 'select count(*) from tracker_mediainfo where ticket_id = tracker_ticket.id',
+    'summary_media_count': 'select sum(count) from tracker_mediainfo where ticket_id = tracker_ticket.id',
+    'summary_expediture_count': 'select count(*) from tracker_expediture where ticket_id = tracker_ticket.id',
+    'summary_expediture_amount': 'select sum(amount) from tracker_expediture where ticket_id = tracker_ticket.id',
+}
+
+class TicketQuerySet(models.query.QuerySet):
+    def with_summaries(self):
+        """ Fetches media and expediture summaries along with the tickets, in the same query. """
+        return self.extra(select=TICKET_SUMMARIES)
+
+class TicketManager(models.Manager):
+    def get_query_set(self):
+        return TicketQuerySet(self.model, using=self._db)
+    
+    def with_summaries(self):
+        return self.get_query_set().with_summaries()
+
+# acks required for ticket expeditures to count as accepted
+ACCEPTED_ACK_TYPES = ('content', 'docs', 'archive')
+
+# extra selects of TICKET_SUMMARIES for all the tickets of a topic at once, see Topic.summary_queryset()
+TOPIC_TICKETS = 'select id from tracker_ticket where topic_id = tracker_topic.id'
+TOPIC_SUMMARIES = {
+    'summary_media_objects': 'select count(*) from tracker_mediainfo where ticket_id in (%s)' % TOPIC_TICKETS,
+    'summary_media_count': 'select sum(count) from tracker_mediainfo where ticket_id in (%s)' % TOPIC_TICKETS,
+    'summary_expediture_count': 'select count(*) from tracker_expediture where ticket_id in (%s)' % TOPIC_TICKETS,
+    'summary_expediture_amount': 'select sum(amount) from tracker_expediture where ticket_id in (%s)' % TOPIC_TICKETS,
+    # in hundredths of a cent, an integer on every backend; see Topic.accepted_expeditures()
+    'summary_accepted_expeditures': 'select sum(round(expediture.amount * 100) * ticket.rating_percentage) from tracker_expediture expediture'
+        ' inner join tracker_ticket ticket on ticket.id = expediture.ticket_id where ticket.topic_id = tracker_topic.id'
+        ' and ticket.rating_percentage > 0 and (ticket.ack_mask & %(mask)d) = %(mask)d' % {'mask': ack_types_mask(ACCEPTED_ACK_TYPES)},
+}
+
 class PercentageField(models.SmallIntegerField):
     """ Field that holds a percentage. """
     def formfield(self, **kwargs):
@@ -61,6 +157,12 @@ class Ticket(models.Model):
     supervisor_notes = models.TextField(_('supervisor notes'), blank=True, help_text=_("This space is for notes of project supervisors and accounting staff."))
     cluster = models.ForeignKey('Cluster', blank=True, null=True, on_delete=models.SET_NULL)
     payment_status = models.CharField(_('payment status'), max_length=20, default='n/a', choices=PAYMENT_STATUS_CHOICES)
+    cluster_update_pending = models.BooleanField(_('payment status refresh pending'), default=False)
+    ack_mask = models.IntegerField(_('acks'), default=0) # ACK_BITS of present acks, maintained by TicketAck signals
+    state = models.CharField(_('state'), max_length=30, default='draft', choices=TICKET_STATES, db_index=True) # see ticket_state()
+    row_version = models.IntegerField(default=0) # bumped whenever the ticket's row in ticket tables changes, see ticket_row_changed()
+    
+    objects = TicketManager()
     
     @staticmethod
     def currency():
@@ -78,38 +180,40 @@ class Ticket(models.Model):
         else:
             self.sort_date = datetime.date.today()
         
+        old_total, old_topic_id = None, None
+        if self.id != None:
+            # fields maintained by ClusterUpdate may be stale in this instance; keep the stored ones
+            stored = Ticket.objects.filter(id=self.id).values('cluster', 'payment_status', 'cluster_update_pending', 'ack_mask', 'topic', 'row_version')
+            if stored:
+                old_topic_id = stored[0]['topic']
+                self.row_version = stored[0]['row_version']
+                self.cluster_id = stored[0]['cluster']
+                self.payment_status = stored[0]['payment_status']
+                self.cluster_update_pending = stored[0]['cluster_update_pending']
+                self.ack_mask = stored[0]['ack_mask']
+                if not cluster_update_only:
+                    old_total = ClusterUpdate.ticket_total(self.id)
+        self.state = ticket_state(self.custom_state, self.ack_mask, self.rating_percentage)
+        
         super(Ticket, self).save(*args, **kwargs)
+        ticket_row_changed([self.id])
         
         if not cluster_update_only:
-            ClusterUpdate.perform(ticket_ids=set([self.id]))
+            if old_topic_id is not None and old_topic_id != self.topic_id:
+                # topic count of the cluster may change too, recount it as a whole
+                ClusterUpdate.perform(ticket_ids=set([self.id]))
+                FinanceSnapshot.refresh_topics([old_topic_id, self.topic_id])
+            else:
+                # rating change is the only other thing on the ticket itself affecting its cluster
+                ClusterUpdate.ticket_total_changed(self.id, old_total)
     
     def _note_comment(self, **kwargs):
         self.save()
     
     def state_str(self):
-        if self.custom_state:
+        if self.state == 'custom':
             return self.custom_state
-        
-        acks = self.ack_set()
-        if 'closed' in acks:
-            return _('closed')
-        elif 'archive' in acks:
-            return _('archived')
-        elif 'content' in acks:
-            if not self.rating_percentage:
-                return _('waiting for content rating')
-            
-            if 'docs' in acks:
-                return _('complete')
-            elif 'user_docs' in acks:
-                return _('waiting for filing of documents')
-            else:
-                return _('waiting for document submission')
-        else:
-            if 'user_content' in acks:
-                return _('waiting for approval')
-            else:
-                return _('draft')
+        return self.get_state_display()
     state_str.admin_order_field = 'state'
     state_str.short_description = _('state')
             
@@ -145,17 +249,26 @@ class Ticket(models.Model):
         return reverse('ticket_detail', kwargs={'pk':self.id})
     
     def media_count(self):
+        if hasattr(self, 'summary_media_objects'):
+            return {'objects': self.summary_media_objects, 'media': self.summary_media_count}
         return self.mediainfo_set.aggregate(objects=models.Count('id'), media=models.Sum('count'))
     
     def expeditures(self):
+        if hasattr(self, 'summary_expediture_count'):
+            amount = self.summary_expediture_amount
+            if amount is not None:
+                amount = connection.ops.convert_values(amount, Expediture._meta.get_field('amount'))
+            return {'count': self.summary_expediture_count, 'amount': amount}
         return self.expediture_set.aggregate(count=models.Count('id'), amount=models.Sum('amount'))
     
     def accepted_expeditures(self):
-        if not self.has_all_acks('content', 'docs', 'archive') or (self.rating_percentage == None):
+        if not self.has_all_acks(*ACCEPTED_ACK_TYPES) or (self.rating_percentage == None):
             return 0
+        elif hasattr(self, 'summary_expediture_amount'):
+            total = self.expeditures()['amount'] or 0
         else:
             total = sum([x.amount for x in self.expediture_set.all()])
-            return total * self.rating_percentage / 100
+        return total * self.rating_percentage / 100
     
     def can_edit(self, user):
         """ Can given user edit this ticket through a non-admin interface? """
@@ -174,17 +287,14 @@ class Ticket(models.Model):
         return self.transaction_set.all().aggregate(amount=models.Sum('amount'))['amount']
     
     def ack_set(self):
-        return set([x.ack_type for x in self.ticketack_set.only('ack_type')])
+        return set([ack_type for ack_type, bit in ACK_BITS.items() if self.ack_mask & bit])
     
     def has_ack(self, ack_type):
-        return self.ticketack_set.filter(ack_type=ack_type).exists()
+        return bool(self.ack_mask & ACK_BITS[ack_type])
     
     def has_all_acks(self, *wanted_acks):
-        acks = self.ack_set()
-        for wanted in wanted_acks:
-            if wanted not in acks:
-                return False
-        return True
+        wanted = ack_types_mask(wanted_acks)
+        return self.ack_mask & wanted == wanted
     
     def add_acks(self, *acks):
         """ Adds acks, mostly for testing. """
@@ -263,6 +373,55 @@ class FinanceStatus(object):
     
     def as_dict(self):
         return {'fuzzy':self.fuzzy, 'unpaid':self.unpaid, 'paid':self.paid, 'overpaid':self.overpaid}
+    
+    @staticmethod
+    def for_topics(topic_ids=None):
+        """
+        Returns {topic_id: FinanceStatus} for given topics (all by default), with the
+        same results as add_ticket() over their tickets, but computed by two grouped
+        queries: accepted expeditures per (topic, payment status, rating) and
+        partially paid/overpaid clusters per topic.
+        """
+        out = {}
+        for topic_id in topic_ids or ():
+            out[topic_id] = FinanceStatus()
+        
+        accepted = ack_types_mask(ACCEPTED_ACK_TYPES)
+        expeditures = Expediture.objects.filter(ticket__payment_status__in=('unpaid', 'paid'), ticket__rating_percentage__isnull=False)
+        expeditures = expeditures.extra(where=['tracker_ticket.ack_mask & %s = %s'], params=[accepted, accepted])
+        if topic_ids is not None:
+            expeditures = expeditures.filter(ticket__topic__in=topic_ids)
+        for row in expeditures.values('ticket__topic', 'ticket__payment_status', 'ticket__rating_percentage').annotate(amount=models.Sum('amount')).order_by():
+            finance = out.setdefault(row['ticket__topic'], FinanceStatus())
+            amount = row['amount'] * row['ticket__rating_percentage'] / 100
+            if row['ticket__payment_status'] == 'unpaid':
+                finance.unpaid += amount
+            else:
+                finance.paid += amount
+        
+        # clusters are split equally among all the topics they span
+        tickets = Ticket.objects.filter(payment_status__in=('partially_paid', 'overpaid'), cluster__isnull=False)
+        if topic_ids is not None:
+            tickets = tickets.filter(cluster__in=Ticket.objects.filter(topic__in=topic_ids).values('cluster'))
+        clusters = {}
+        for cluster_id, topic_id, total_tickets, total_transactions in tickets.values_list(
+                'cluster', 'topic', 'cluster__total_tickets', 'cluster__total_transactions').distinct().order_by():
+            clusters.setdefault(cluster_id, (total_tickets or 0, total_transactions or 0, []))[2].append(topic_id)
+        for cluster_id, (total_tickets, total_transactions, cluster_topics) in sorted(clusters.items()):
+            count = len(cluster_topics)
+            for topic_id in cluster_topics:
+                if topic_ids is not None and topic_id not in out:
+                    continue
+                finance = out.setdefault(topic_id, FinanceStatus())
+                finance.fuzzy = finance.fuzzy or count > 1
+                finance.seen_cluster_ids.add(cluster_id)
+                if total_transactions < total_tickets: # partially paid
+                    finance.paid += total_transactions / count
+                    finance.unpaid += (total_tickets - total_transactions) / count
+                else: # overpaid
+                    finance.paid += total_tickets / count
+                    finance.overpaid += (total_transactions - total_tickets) / count
+        return out
 
 
 class Topic(models.Model):
@@ -282,27 +441,59 @@ class Topic(models.Model):
     def get_absolute_url(self):
         return reverse('topic_detail', kwargs={'pk':self.id})
     
+    @staticmethod
+    def summary_queryset():
+        """ Topics fetched along with the summaries of all their tickets, in the same query. """
+        return Topic.objects.extra(select=TOPIC_SUMMARIES)
+    
     def media_count(self):
+        if hasattr(self, 'summary_media_objects'):
+            return {'objects': self.summary_media_objects, 'media': self.summary_media_count}
         return MediaInfo.objects.extra(where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(objects=models.Count('id'), media=models.Sum('count'))
     
     def expeditures(self):
+        if hasattr(self, 'summary_expediture_count'):
+            amount = self.summary_expediture_amount
+            if amount is not None:
+                amount = connection.ops.convert_values(amount, Expediture._meta.get_field('amount'))
+            return {'count': self.summary_expediture_count, 'amount': amount}
         return Expediture.objects.extra(where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
     
     def accepted_expeditures(self):
+        if hasattr(self, 'summary_accepted_expeditures'):
+            if self.summary_accepted_expeditures is None:
+                return 0
+            return Decimal(int(self.summary_accepted_expeditures)) / 10000
         return sum([t.accepted_expeditures() for t in self.ticket_set.filter(rating_percentage__gt=0)])
     
+    def finance_snapshot(self):
+        if hasattr(self, 'prefetched_snapshot'):
+            return self.prefetched_snapshot
+        return FinanceSnapshot.for_topic(self)
+    
+    def admin_list(self):
+        if hasattr(self, 'prefetched_admins'):
+            return self.prefetched_admins
+        return self.admin.all()
+    
     def tickets_per_payment_status(self):
-        out = {}
-        for s in self.ticket_set.values('payment_status').annotate(models.Count('payment_status')):
-            out[s['payment_status']] = s['payment_status__count']
-        return out
+        return self.finance_snapshot().tickets_per_payment_status()
     
     def payment_summary(self):
-        finance = FinanceStatus()
-        for ticket in self.ticket_set.all():
-            finance.add_ticket(ticket)
-        
-        return finance
+        return FinanceStatus.for_topics([self.id])[self.id]
+    
+    @staticmethod
+    def prefetch_table(topics):
+        """ Fills finance_snapshot() and admin_list() of given topics by two queries, for topic tables. """
+        by_id = dict([(topic.id, topic) for topic in topics])
+        if not by_id:
+            return
+        snapshots = FinanceSnapshot.load(by_id.keys())
+        for topic in topics:
+            topic.prefetched_snapshot = snapshots.get((topic.id, topic.grant_id)) or FinanceSnapshot(topic_id=topic.id, grant_id=topic.grant_id)
+            topic.prefetched_admins = []
+        for link in Topic.admin.through.objects.filter(topic__in=by_id.keys()).select_related('user').order_by('id'):
+            by_id[link.topic_id].prefetched_admins.append(link.user)
     
     class Meta:
         verbose_name = _('Topic')
@@ -312,6 +503,66 @@ class Topic(models.Model):
             ("supervisor", "Can edit all topics and tickets"),
         )
 
+# in-process copy of topic_form_data(), valid while its version is the shared one
+_topic_form_data = {}
+
+def topic_form_data():
+    """
+    Returns (version, {topic_id: fields}) with the topic fields ticket forms need.
+    Kept in process and in the shared cache; version is the time of the last
+    Topic change, shared by all the processes through the cache.
+    """
+    version = cache.get(TOPIC_FORM_DATA_CACHE_KEY + ':version')
+    if version is not None and _topic_form_data.get('version') == version:
+        return version, _topic_form_data['data']
+    
+    data = None
+    if version is not None:
+        data = cache.get('%s:%r' % (TOPIC_FORM_DATA_CACHE_KEY, version))
+    if data is None:
+        if version is None:
+            version = time.time()
+            cache.set(TOPIC_FORM_DATA_CACHE_KEY + ':version', version, VERSIONED_CACHE_TIMEOUT)
+        data = {}
+        for fields in Topic.objects.values('id', 'open_for_tickets', 'form_description', 'ticket_media', 'ticket_expenses'):
+            data[fields.pop('id')] = fields
+        cache.set('%s:%r' % (TOPIC_FORM_DATA_CACHE_KEY, version), data, VERSIONED_CACHE_TIMEOUT)
+    _topic_form_data.clear()
+    _topic_form_data.update(version=version, data=data)
+    return version, data
+
+@receiver(models.signals.post_save, sender=Topic)
+@receiver(models.signals.post_delete, sender=Topic)
+def topic_form_data_invalidate(sender, **kwargs):
+    _topic_form_data.clear()
+    cache.set(TOPIC_FORM_DATA_CACHE_KEY + ':version', time.time(), VERSIONED_CACHE_TIMEOUT)
+
+def feed_version(kind):
+    """
+    Time of the last change of what feeds of given kind ('tickets' or
+    'transactions') show; shared by all the processes through the cache.
+    A version lost from the cache starts anew from now, never going back.
+    """
+    key = '%s:%s' % (FEED_VERSION_CACHE_KEY, kind)
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        # another process may have set it meanwhile
+        if not cache.add(key, version, VERSIONED_CACHE_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+def feed_changed(kind):
+    cache.set('%s:%s' % (FEED_VERSION_CACHE_KEY, kind), time.time(), VERSIONED_CACHE_TIMEOUT)
+
+@receiver(models.signals.post_save, sender=Topic)
+@receiver(models.signals.post_delete, sender=Topic)
+@receiver(models.signals.post_delete, sender=Ticket)
+@receiver(clusters_updated)
+def tickets_feed_invalidate(sender, **kwargs):
+    # ticket saves and other changes of ticket rows are noted by ticket_row_changed()
+    feed_changed('tickets')
+
 class Grant(models.Model):
     """ Grant is the bigger thing above topics """
     full_name = models.CharField(_('full name'), max_length=80, help_text=_('Full name for headlines and such'))
@@ -331,12 +582,30 @@ class Grant(models.Model):
         ordering = ['full_name']
 
 
+@receiver(models.signals.post_save, sender=Topic)
+def ticket_row_topic_update(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    ticket_row_changed(instance.ticket_set.values_list('id', flat=True))
+
+@receiver(models.signals.post_save, sender=Grant)
+def ticket_row_grant_update(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    ticket_row_changed(Ticket.objects.filter(topic__grant=instance).values_list('id', flat=True))
+
 @receiver(comment_was_posted)
 def ticket_note_comment(sender, comment, **kwargs):
     obj = comment.content_object 
     if type(obj) == Ticket:
         obj.save()
 
+def ticket_row_changed(ticket_ids):
+    """ Bumps row_version of given tickets, so that their cached ticket table rows get rendered anew. """
+    for chunk in chunked(ticket_ids):
+        Ticket.objects.filter(id__in=chunk).update(row_version=models.F('row_version') + 1)
+    feed_changed('tickets')
+
 class MediaInfo(models.Model):
     """ Media related to particular tickets. """
     ticket = models.ForeignKey('tracker.Ticket', verbose_name=_('ticket'), help_text=_('Ticket this media info belongs to'))
@@ -363,14 +632,33 @@ class Expediture(models.Model):
     
     def save(self, *args, **kwargs):
         cluster_update_only = kwargs.pop('cluster_update_only', False)
+        if cluster_update_only or self.ticket_id == None:
+            super(Expediture, self).save(*args, **kwargs)
+            return
+        
+        old_ticket_id = None
+        if self.id != None:
+            old_ticket_id = Expediture.objects.filter(id=self.id).values_list('ticket', flat=True)
+            old_ticket_id = old_ticket_id[0] if old_ticket_id else None
+        old_total = ClusterUpdate.ticket_total(self.ticket_id)
         super(Expediture, self).save(*args, **kwargs)
-        if not cluster_update_only and self.ticket.id != None:
-            ClusterUpdate.perform(ticket_ids=set([self.ticket.id]))
+        ClusterUpdate.ticket_total_changed(self.ticket_id, old_total)
+        if old_ticket_id not in (None, self.ticket_id):
+            ClusterUpdate.perform(ticket_ids=set([old_ticket_id]))
     
     class Meta:
         verbose_name = _('Ticket expediture')
         verbose_name_plural = _('Ticket expeditures')
 
+@receiver(models.signals.post_save, sender=MediaInfo)
+@receiver(models.signals.post_delete, sender=MediaInfo)
+@receiver(models.signals.post_save, sender=Expediture)
+@receiver(models.signals.post_delete, sender=Expediture)
+def ticket_row_item_update(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    ticket_row_changed([instance.ticket_id])
+
 class TrackerDocumentStorage(FileSystemStorage):
     def __init__(self):
         self.location = settings.TRACKER_DOCS_ROOT
@@ -425,6 +713,36 @@ class UserProfile(models.Model):
     
     def transactions(self):
         return Transaction.objects.filter(other=self.user).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
+    
+    @staticmethod
+    def summaries():
+        """
+        Returns {user_id: {'ticket_count', 'media', 'accepted_expeditures', 'transactions'}}
+        with the figures of the methods above for all the users at once, computed by one
+        grouped query per column; the None key stands for tickets and transactions with
+        no tracker user. Users with nothing to show are left out.
+        """
+        out = {}
+        def summary(user_id):
+            return out.setdefault(user_id, {
+                'ticket_count': 0,
+                'media': {'objects': 0, 'media': None},
+                'accepted_expeditures': 0,
+                'transactions': {'count': 0, 'amount': None},
+            })
+        
+        for user_id, count in Ticket.objects.values_list('requested_user').annotate(models.Count('id')).order_by():
+            summary(user_id)['ticket_count'] = count
+        for row in MediaInfo.objects.values('ticket__requested_user').annotate(objects=models.Count('id'), media=models.Sum('count')).order_by():
+            summary(row.pop('ticket__requested_user'))['media'] = row
+        accepted = ack_types_mask(ACCEPTED_ACK_TYPES)
+        expeditures = Expediture.objects.filter(ticket__rating_percentage__gt=0).extra(
+            where=['tracker_ticket.ack_mask & %s = %s'], params=[accepted, accepted])
+        for row in expeditures.values('ticket__requested_user', 'ticket__rating_percentage').annotate(amount=models.Sum('amount')).order_by():
+            summary(row['ticket__requested_user'])['accepted_expeditures'] += row['amount'] * row['ticket__rating_percentage'] / 100
+        for row in Transaction.objects.values('other').annotate(count=models.Count('id'), amount=models.Sum('amount')).order_by():
+            summary(row.pop('other'))['transactions'] = row
+        return out
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, **kwargs):
@@ -434,6 +752,20 @@ def create_user_profile(sender, **kwargs):
     user = kwargs['instance']
     profile = UserProfile.objects.create(user=user)
 
+@receiver(models.signals.pre_save, sender=User)
+def ticket_row_user_note(sender, instance, raw=False, **kwargs):
+    if raw or instance.id is None:
+        return
+    instance._old_usernames = list(User.objects.filter(id=instance.id).values_list('username', flat=True))
+
+@receiver(post_save, sender=User)
+def ticket_row_user_update(sender, instance, created, raw=False, **kwargs):
+    # rows and feeds show the username only, logins and such don't matter
+    if raw or created or getattr(instance, '_old_usernames', [instance.username]) == [instance.username]:
+        return
+    ticket_row_changed(instance.ticket_set.values_list('id', flat=True))
+    feed_changed('transactions')
+
 class Transaction(models.Model):
     """ One payment to or from the user. """
     date = models.DateField(_('date'))
@@ -469,9 +801,13 @@ class Transaction(models.Model):
         return u', '.join([unicode(t.id) for t in self.tickets.order_by('id')])
     
     def tickets_by_id(self):
+        if hasattr(self, 'prefetched_tickets'):
+            return self.prefetched_tickets
         return self.tickets.order_by('id')
     
     def grant_set(self):
+        if hasattr(self, 'prefetched_grants'):
+            return self.prefetched_grants
         return Grant.objects.extra(where=['id in (select grant_id from tracker_topic topic where topic.id in (select topic_id from tracker_ticket ticket where ticket.id in (select ticket_id from tracker_transaction_tickets where transaction_id = %s)))'], params=[self.id]).order_by('id')
     
     def save(self, *args, **kwargs):
@@ -484,17 +820,54 @@ class Transaction(models.Model):
     def currency():
         return settings.TRACKER_CURRENCY
     
+    @staticmethod
+    def prefetch_links(transactions):
+        """ Fills tickets_by_id() and grant_set() of given transactions by a single query. """
+        by_id = dict([(tx.id, tx) for tx in transactions])
+        for tx in transactions:
+            tx.prefetched_tickets, tx.prefetched_grants = [], []
+        links = Transaction.tickets.through.objects.filter(transaction__in=by_id.keys()).select_related('ticket__topic__grant')
+        for link in links.order_by('ticket'):
+            tx, grant = by_id[link.transaction_id], link.ticket.topic.grant
+            tx.prefetched_tickets.append(link.ticket)
+            if grant not in tx.prefetched_grants:
+                tx.prefetched_grants.append(grant)
+        for tx in transactions:
+            tx.prefetched_grants.sort(key=lambda grant: grant.id)
+    
+    @staticmethod
+    def total():
+        """ Sum of all the transactions, cached until a transaction is saved or deleted. """
+        cached = cache.get(TRANSACTION_TOTAL_CACHE_KEY)
+        if cached is None:
+            cached = (Transaction.objects.aggregate(amount=models.Sum('amount'))['amount'], )
+            cache.set(TRANSACTION_TOTAL_CACHE_KEY, cached)
+        return cached[0]
+    
     class Meta:
         verbose_name = _('Transaction')
         verbose_name_plural = _('Transactions')
         ordering = ['-date']
 
+@receiver(models.signals.post_save, sender=Transaction)
+@receiver(models.signals.post_delete, sender=Transaction)
+def transaction_total_invalidate(sender, **kwargs):
+    cache.delete(TRANSACTION_TOTAL_CACHE_KEY)
+
+@receiver(models.signals.post_save, sender=Transaction)
+@receiver(models.signals.post_delete, sender=Transaction)
+def transactions_feed_invalidate(sender, **kwargs):
+    feed_changed('transactions')
+
 class Cluster(models.Model):
     """ This is an auxiliary/cache model used to track relationships between tickets and payments. """
     id = models.IntegerField(primary_key=True) # cluster ID is always the id of its lowest-numbered ticket
     more_tickets = models.BooleanField() # does this cluster have more tickets?
     total_tickets = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True) # refreshed on cluster status update
     total_transactions = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True) # refreshed on cluster status update
+    ticket_count = models.IntegerField(default=0) # member counts, maintained by ClusterUpdate along with the totals
+    transaction_count = models.IntegerField(default=0)
+    topic_count = models.IntegerField(default=0)
     
     def get_absolute_url(self):
         return reverse('cluster_detail', kwargs={'pk':self.id})
@@ -515,43 +888,244 @@ class Cluster(models.Model):
         else: # paid > tickets
             return 'overpaid'
     
+    def get_status_display(self):
+        return dict(PAYMENT_STATUS_CHOICES)[self.get_status()]
+    
     def get_topic_count(self):
         """ Retuns number of topic this cluster spans """
         topic_set = set([t.topic_id for t in self.ticket_set.only('topic').select_related('topic')])
         return len(topic_set)
     
     def update_status(self):
-        """ Recounts all the summaries and updates payment status in tickets. """
-        self.total_tickets = sum([t.accepted_expeditures() for t in self.ticket_set.all()])
-        self.total_transactions = self.transaction_set.all().aggregate(amount=models.Sum('amount'))['amount']
-        status = self.get_status()
-        for t in self.ticket_set.all():
-            t.payment_status = status
-            t.save(cluster_update_only=True)
-        self.save()
+        """ Recounts the cluster and payment statuses of its tickets (see ClusterUpdate). """
+        return ClusterUpdate.perform(ticket_ids=set(self.ticket_set.values_list('id', flat=True)))
     
     def __unicode__(self):
         return unicode(self.id)
     
     @staticmethod
     def cluster_sums():
+        total = FinanceSnapshot.load()[(None, None)]
+        return {'unpaid':total.unpaid, 'paid':total.paid, 'overpaid':total.overpaid}
+    
+    @staticmethod
+    def live_cluster_sums():
+        """ Computes cluster_sums() from the clusters by aggregate queries; a missing total counts as 0. """
+        def totals(**filters):
+            found = Cluster.objects.filter(**filters).aggregate(tickets=models.Sum('total_tickets'), transactions=models.Sum('total_transactions'))
+            return found['tickets'] or 0, found['transactions'] or 0
+        
         sums = {'unpaid':0, 'paid':0, 'overpaid':0}
-        for cluster in Cluster.objects.all():
-            tickets = cluster.total_tickets or 0
-            transactions = cluster.total_transactions or 0
-            if tickets == transactions:
-                # paid
-                sums['paid'] += tickets
-            elif tickets > transactions:
-                # unpaid or partially paid
-                sums['paid'] += transactions
-                sums['unpaid'] += tickets - transactions
-            else:
-                # overpaid
-                sums['paid'] += tickets
-                sums['overpaid'] += transactions - tickets
+        # no transactions
+        tickets, transactions = totals(total_transactions__isnull=True, total_tickets__gt=0)
+        sums['unpaid'] += tickets
+        tickets, transactions = totals(total_transactions__isnull=True, total_tickets__lt=0)
+        sums['paid'] += tickets
+        sums['overpaid'] -= tickets
+        # no tickets
+        tickets, transactions = totals(total_tickets__isnull=True, total_transactions__gt=0)
+        sums['overpaid'] += transactions
+        tickets, transactions = totals(total_tickets__isnull=True, total_transactions__lt=0)
+        sums['paid'] += transactions
+        sums['unpaid'] -= transactions
+        # unpaid or partially paid
+        tickets, transactions = totals(total_tickets__gt=models.F('total_transactions'))
+        sums['paid'] += transactions
+        sums['unpaid'] += tickets - transactions
+        # paid or overpaid
+        tickets, transactions = totals(total_tickets__lte=models.F('total_transactions'))
+        sums['paid'] += tickets
+        sums['overpaid'] += transactions - tickets
         return sums
 
+class ClusterUpdateJob(models.Model):
+    """
+    Queued cluster update, used when TRACKER_CLUSTER_UPDATE_QUEUE is on;
+    processed by the process_cluster_updates management command.
+    """
+    ticket_id = models.IntegerField(blank=True, null=True) # not a foreign key, the item may be gone by then
+    transaction_id = models.IntegerField(blank=True, null=True)
+    queued = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        if self.ticket_id is not None:
+            return u'ticket %s' % self.ticket_id
+        else:
+            return u'transaction %s' % self.transaction_id
+
+class FinanceSnapshot(models.Model):
+    """
+    Materialized finance figures of a topic, of a whole grant (no topic) or of
+    everything (neither); the total row holds Cluster.live_cluster_sums().
+    Kept up to date by signals, see FinanceSnapshot.refresh().
+    """
+    topic_id = models.IntegerField(blank=True, null=True) # not foreign keys, rows of deleted items go on the next refresh
+    grant_id = models.IntegerField(blank=True, null=True)
+    fuzzy = models.BooleanField(default=False)
+    unpaid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    overpaid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    tickets = models.IntegerField(default=0)
+    tickets_n_a = models.IntegerField(default=0)
+    tickets_unpaid = models.IntegerField(default=0)
+    tickets_partially_paid = models.IntegerField(default=0)
+    tickets_paid = models.IntegerField(default=0)
+    tickets_overpaid = models.IntegerField(default=0)
+    
+    FIELDS = ('fuzzy', 'unpaid', 'paid', 'overpaid', 'tickets') + tuple(['tickets_' + status for status, display in PAYMENT_STATUS_CHOICES])
+    
+    def __unicode__(self):
+        return u'%s/%s' % (self.grant_id, self.topic_id)
+    
+    def finance(self):
+        return FinanceStatus(self.fuzzy, self.unpaid, self.paid, self.overpaid)
+    
+    def tickets_per_payment_status(self):
+        out = {}
+        for status, display in PAYMENT_STATUS_CHOICES:
+            count = getattr(self, 'tickets_' + status)
+            if count:
+                out[status] = count
+        return out
+    
+    def values(self):
+        return dict([(name, getattr(self, name)) for name in FinanceSnapshot.FIELDS])
+    
+    @staticmethod
+    def _values(finance, counts):
+        values = {'fuzzy': finance.fuzzy, 'tickets': sum(counts.values())}
+        for name in ('unpaid', 'paid', 'overpaid'):
+            values[name] = quantize_total(getattr(finance, name))
+        for status, display in PAYMENT_STATUS_CHOICES:
+            values['tickets_' + status] = counts.get(status, 0)
+        return values
+    
+    @staticmethod
+    def compute(grant_ids=None):
+        """
+        Computes snapshot values of given grants and their topics (all by
+        default) and of the total; returns {(topic_id, grant_id): values}.
+        """
+        grants, topics, tickets = Grant.objects.all(), Topic.objects.all(), Ticket.objects.all()
+        if grant_ids is not None:
+            grants, topics, tickets = grants.filter(id__in=grant_ids), topics.filter(grant__in=grant_ids), tickets.filter(topic__grant__in=grant_ids)
+        topic_grants = dict(topics.values_list('id', 'grant'))
+        finances = FinanceStatus.for_topics(topic_grants.keys())
+        counts = {}
+        for topic_id, status, count in tickets.values_list('topic', 'payment_status').annotate(models.Count('id')).order_by():
+            counts.setdefault(topic_id, {})[status] = count
+        
+        out = {}
+        grants = dict([(grant_id, (FinanceStatus(), {})) for grant_id in grants.values_list('id', flat=True)])
+        for topic_id, grant_id in topic_grants.items():
+            topic_counts = counts.get(topic_id, {})
+            out[(topic_id, grant_id)] = FinanceSnapshot._values(finances[topic_id], topic_counts)
+            grant_finance, grant_counts = grants.setdefault(grant_id, (FinanceStatus(), {}))
+            grant_finance.add_finance(finances[topic_id])
+            for status, count in topic_counts.items():
+                grant_counts[status] = grant_counts.get(status, 0) + count
+        for grant_id, (grant_finance, grant_counts) in grants.items():
+            out[(None, grant_id)] = FinanceSnapshot._values(grant_finance, grant_counts)
+        
+        total_counts = dict(Ticket.objects.values_list('payment_status').annotate(models.Count('id')).order_by())
+        out[(None, None)] = FinanceSnapshot._values(FinanceStatus(**Cluster.live_cluster_sums()), total_counts)
+        return out
+    
+    @staticmethod
+    def refresh(grant_ids=None):
+        """
+        Recomputes and stores the rows of given grants (all by default) and the
+        total row; all the rows while there is no total row, ie. no snapshot yet.
+        """
+        if grant_ids is not None:
+            grant_ids = set(grant_ids) - set([None])
+            if not FinanceSnapshot.objects.filter(topic_id__isnull=True, grant_id__isnull=True).exists():
+                grant_ids = None
+        computed = FinanceSnapshot.compute(grant_ids)
+        stored = FinanceSnapshot.objects.all()
+        if grant_ids is not None:
+            stored = stored.filter(models.Q(grant_id__in=grant_ids) | models.Q(grant_id__isnull=True))
+        stored = dict([((row.topic_id, row.grant_id), row) for row in stored])
+        
+        for key, row in stored.items():
+            if key not in computed:
+                row.delete() # topic moved to another grant or gone
+        for key, values in computed.items():
+            row = stored.get(key)
+            if row is None:
+                FinanceSnapshot.objects.create(topic_id=key[0], grant_id=key[1], **values)
+            elif row.values() != values:
+                FinanceSnapshot.objects.filter(id=row.id).update(**values)
+    
+    @staticmethod
+    def refresh_topics(topic_ids):
+        """ Refreshes rows of grants the given topics belong to. """
+        grant_ids = set()
+        for chunk in chunked(topic_ids):
+            grant_ids.update(Topic.objects.filter(id__in=chunk).values_list('grant', flat=True))
+        FinanceSnapshot.refresh(grant_ids)
+    
+    @staticmethod
+    def load(topic_ids=None):
+        """
+        Returns {(topic_id, grant_id): FinanceSnapshot} of given topics and
+        all the grants (everything by default); builds the snapshot first if
+        there is none yet, and the rows of grants that miss some.
+        """
+        rows = FinanceSnapshot.objects.all()
+        if topic_ids is not None:
+            rows = rows.filter(models.Q(topic_id__in=topic_ids) | models.Q(topic_id__isnull=True))
+        for attempt in range(2):
+            out = dict([((row.topic_id, row.grant_id), row) for row in rows.all()])
+            if (None, None) not in out:
+                FinanceSnapshot.refresh()
+                continue
+            # missing rows are not zeros, but rows that were never computed
+            grant_ids = set([grant_id for topic_id, grant_id in out if topic_id is not None and (None, grant_id) not in out])
+            missing_topics = set(topic_ids or ()) - set([topic_id for topic_id, grant_id in out])
+            for chunk in chunked(missing_topics):
+                grant_ids.update(Topic.objects.filter(id__in=chunk).values_list('grant', flat=True))
+            if not grant_ids or attempt > 0:
+                break
+            FinanceSnapshot.refresh(grant_ids)
+        return out
+    
+    @staticmethod
+    def for_topic(topic):
+        rows = FinanceSnapshot.load([topic.id])
+        return rows.get((topic.id, topic.grant_id)) or FinanceSnapshot(topic_id=topic.id, grant_id=topic.grant_id)
+
+@receiver(clusters_updated)
+def finance_snapshot_clusters_update(sender, changes, **kwargs):
+    topic_ids = set()
+    for chunk in chunked(changes.tickets):
+        topic_ids.update(Ticket.objects.filter(id__in=chunk).values_list('topic', flat=True))
+    FinanceSnapshot.refresh_topics(topic_ids)
+
+@receiver(models.signals.pre_save, sender=Topic)
+def finance_snapshot_topic_note(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._old_grant_ids = set(Topic.objects.filter(id=instance.id).values_list('grant', flat=True))
+
+@receiver(models.signals.post_save, sender=Topic)
+def finance_snapshot_topic_update(sender, instance, created, raw=False, **kwargs):
+    old_grant_ids = getattr(instance, '_old_grant_ids', set())
+    if raw or (not created and old_grant_ids == set([instance.grant_id])):
+        return
+    FinanceSnapshot.refresh(old_grant_ids | set([instance.grant_id]))
+
+@receiver(models.signals.post_delete, sender=Topic)
+def finance_snapshot_topic_delete(sender, instance, **kwargs):
+    FinanceSnapshot.refresh([instance.grant_id])
+
+@receiver(models.signals.post_save, sender=Grant)
+@receiver(models.signals.post_delete, sender=Grant)
+def finance_snapshot_grant_update(sender, instance, created=True, raw=False, **kwargs):
+    if raw or not created: # post_delete has no created argument
+        return
+    FinanceSnapshot.refresh([instance.id])
+
 @receiver(models.signals.m2m_changed)
 def cluster_note_transaction_link(sender, instance, action, **kwargs):
     if action not in ('post_add', 'post_remove', 'post_clear'):
@@ -564,15 +1138,39 @@ def cluster_note_transaction_link(sender, instance, action, **kwargs):
 
 @receiver(models.signals.pre_delete)
 def cluster_member_delete(sender, instance, **kwargs):
+    if sender not in (Ticket, Transaction):
+        return
+    
+    # note down items which will need a cluster refresh once this one is gone
+    neighbours = ClusterGroup()
     if sender == Transaction:
-        instance.tickets.clear()
-    elif sender == Ticket:
-        instance.transaction_set.clear()
-        
-        # if previous clear produced a new cluster (which can happen for tickets, delete it)
-        cluster_refreshed = Ticket.objects.get(id=instance.id).cluster
-        if cluster_refreshed != None:
-            cluster_refreshed.delete()
+        neighbours.tickets.update(instance.tickets.values_list('id', flat=True))
+    else:
+        neighbours.transactions.update(instance.transaction_set.values_list('id', flat=True))
+    
+    cluster_id = sender.objects.filter(id=instance.id).values_list('cluster', flat=True)[0]
+    if cluster_id is not None:
+        neighbours.tickets.update(Ticket.objects.filter(cluster=cluster_id).values_list('id', flat=True))
+        neighbours.transactions.update(Transaction.objects.filter(cluster=cluster_id).values_list('id', flat=True))
+    
+    if sender == Transaction:
+        neighbours.transactions.discard(instance.id)
+    else:
+        neighbours.tickets.discard(instance.id)
+    instance._cluster_neighbours = (cluster_id, neighbours)
+
+@receiver(models.signals.post_delete)
+def cluster_member_post_delete(sender, instance, **kwargs):
+    if not hasattr(instance, '_cluster_neighbours'):
+        return
+    
+    cluster_id, neighbours = instance._cluster_neighbours
+    if neighbours.has_items():
+        ClusterUpdate.perform(ticket_ids=neighbours.tickets, transaction_ids=neighbours.transactions)
+    elif cluster_id is not None:
+        Cluster.objects.filter(id=cluster_id).delete()
+    if sender == Ticket:
+        FinanceSnapshot.refresh_topics([instance.topic_id])
 
 
 class TicketAck(models.Model):
@@ -601,6 +1199,37 @@ class TicketAck(models.Model):
     class Meta:
         ordering = ['added']
 
+@receiver(models.signals.post_save, sender=TicketAck)
+@receiver(models.signals.post_delete, sender=TicketAck)
+def ticket_ack_mask_update(sender, instance, **kwargs):
+    """ Keeps Ticket.ack_mask and state in sync, including the ticket instance cached on the ack. """
+    stored = Ticket.objects.filter(id=instance.ticket_id).values('custom_state', 'rating_percentage')
+    if not stored:
+        return # ticket is being deleted
+    mask = ack_types_mask(TicketAck.objects.filter(ticket=instance.ticket_id).values_list('ack_type', flat=True).distinct())
+    state = ticket_state(stored[0]['custom_state'], mask, stored[0]['rating_percentage'])
+    Ticket.objects.filter(id=instance.ticket_id).update(ack_mask=mask, state=state, row_version=models.F('row_version') + 1)
+    feed_changed('tickets')
+    ticket = getattr(instance, TicketAck._meta.get_field('ticket').get_cache_name(), None)
+    if ticket is not None:
+        ticket.ack_mask, ticket.state = mask, state
+
+@receiver(models.signals.pre_delete, sender=Expediture)
+@receiver(models.signals.pre_save, sender=TicketAck)
+@receiver(models.signals.pre_delete, sender=TicketAck)
+def ticket_total_note(sender, instance, raw=False, **kwargs):
+    if raw or instance.ticket_id == None:
+        return
+    instance._old_ticket_total = ClusterUpdate.ticket_total(instance.ticket_id)
+
+@receiver(models.signals.post_delete, sender=Expediture)
+@receiver(models.signals.post_save, sender=TicketAck)
+@receiver(models.signals.post_delete, sender=TicketAck)
+def ticket_total_update(sender, instance, raw=False, **kwargs):
+    if raw or not hasattr(instance, '_old_ticket_total'):
+        return
+    ClusterUpdate.ticket_total_changed(instance.ticket_id, instance._old_ticket_total)
+
 class PossibleAck(object):
     """ Python representation of possible ack that can be added by user to a ticket. """
     _display_names = dict(ACK_TYPES)
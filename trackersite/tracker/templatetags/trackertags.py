@@ -3,6 +3,9 @@ from django import template
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from django.utils.formats import number_format
+from django.utils import translation
+from django.core.cache import cache
+from tracker.models import VERSIONED_CACHE_TIMEOUT
 
 register = template.Library()
 
@@ -13,3 +16,41 @@ def money(value):
     else:
         out = number_format(value, 2)
     return mark_safe(u'%s&nbsp;%s' % (out, settings.TRACKER_CURRENCY))
+
+# context variables of tracker/ticket_table.html that change the rows
+TICKET_ROW_COLUMNS = ('show_media', 'show_expenses', 'show_topics', 'show_requester', 'show_grants')
+
+class TicketRowsNode(template.Node):
+    def __init__(self, tickets):
+        self.tickets = template.Variable(tickets)
+    
+    def render(self, context):
+        tickets = list(self.tickets.resolve(context))
+        columns = ''.join([context.get(name) and '1' or '0' for name in TICKET_ROW_COLUMNS])
+        prefix = 'tracker:ticket_row:%s:%s' % (translation.get_language(), columns)
+        # creation time tells apart tickets of reused ids (after a database restore and such)
+        keys = ['%s:%d:%s:%d' % (prefix, ticket.id, ticket.created.isoformat(), ticket.row_version) for ticket in tickets]
+        rows = cache.get_many(keys)
+        
+        missing = {}
+        row_template = template.loader.get_template('tracker/ticket_row.html')
+        for key, ticket in zip(keys, tickets):
+            if key not in rows:
+                context.push()
+                context['ticket'] = ticket
+                rows[key] = missing[key] = row_template.render(context)
+                context.pop()
+        if missing:
+            cache.set_many(missing, VERSIONED_CACHE_TIMEOUT)
+        return mark_safe(u''.join([rows[key] for key in keys]))
+
+@register.tag
+def ticket_rows(parser, token):
+    """
+    {% ticket_rows ticket_list %} renders tracker/ticket_row.html for each of
+    the tickets; rendered rows are cached until the ticket's row_version changes.
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError('%r tag takes one argument' % bits[0])
+    return TicketRowsNode(bits[1])
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import os
+import tempfile
+from decimal import Decimal
+from StringIO import StringIO
 
 from django.test import TestCase
 from django.test.client import Client
@@ -9,8 +13,27 @@ from django.contrib.auth.models import User, Permission, SiteProfileNotAvailable
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.core.cache import cache
+from django.http import HttpResponse
 
-from tracker.models import Ticket, Topic, FinanceStatus, Grant, MediaInfo, Expediture, Transaction, UserProfile, Document, Cluster
+from tracker.models import Ticket, Topic, FinanceStatus, FinanceSnapshot, Grant, MediaInfo, Expediture, Transaction, UserProfile, Document, Cluster, ClusterUpdateJob, FEED_VERSION_CACHE_KEY
+from tracker.clusters import ClusterUpdate, ClusterGroup, ClusterGraph, coalesced_updates, ticket_totals, check_clusters
+from tracker.middleware import ClusterUpdateMiddleware
+from tracker.views import transaction_csv_lines, _topics_js
+from tracker.management.commands.refresh_clusters import partition_key
+
+def executed_sql(func, *args, **kwargs):
+    """ Calls func and returns the SQL of the queries it ran. """
+    connection.use_debug_cursor = True
+    try:
+        del connection.queries[:]
+        func(*args, **kwargs)
+        return [query['sql'] for query in connection.queries]
+    finally:
+        connection.use_debug_cursor = False
 
 class SimpleTicketTest(TestCase):
     def setUp(self):
@@ -48,7 +71,63 @@ class SimpleTicketTest(TestCase):
         response = Client().get(reverse('ticket_list'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['ticket_list']), 2)
-
+    
+    def test_ticket_list_pages(self):
+        for day in (3, 1, 2, 2):
+            Ticket.objects.create(summary='day %d' % day, topic=self.topic, event_date=datetime.date(2011, 10, day))
+        expected = list(Ticket.objects.order_by('-sort_date', '-id'))
+        
+        old_size = settings.TRACKER_TICKETS_PER_PAGE
+        settings.TRACKER_TICKETS_PER_PAGE = 4
+        try:
+            pages, urls, url = [], [], reverse('ticket_list')
+            while url:
+                urls.append(url)
+                response = Client().get(url)
+                pages.append(list(response.context['ticket_list']))
+                url = 'next_page_url' in response.context and reverse('ticket_list') + response.context['next_page_url']
+            self.assertEqual([expected[:4], expected[4:]], pages)
+            
+            # pages seek by a plain range bound on the date as well
+            sql = executed_sql(Client().get, reverse('ticket_list') + response.context['previous_page_url'])
+            self.assertTrue([query for query in sql if '"tracker_ticket"."sort_date" >= ' in query])
+            sql = executed_sql(Client().get, urls[1])
+            self.assertTrue([query for query in sql if '"tracker_ticket"."sort_date" <= ' in query])
+            
+            # and back
+            previous_url = reverse('ticket_list') + response.context['previous_page_url']
+            response = Client().get(previous_url)
+            self.assertEqual(expected[:4], list(response.context['ticket_list']))
+            self.assertFalse('previous_page_url' in response.context)
+            self.assertTrue('next_page_url' in response.context)
+        finally:
+            settings.TRACKER_TICKETS_PER_PAGE = old_size
+    
+    def test_ticket_list_filters(self):
+        other_topic = Topic.objects.create(name='topic2', grant=Grant.objects.create(full_name='g2', short_name='g2', slug='g2'))
+        user = User.objects.create(username='requester')
+        ticket = Ticket.objects.create(summary='filtered', topic=other_topic, requested_user=user, event_date=datetime.date(2011, 10, 13))
+        
+        def tickets(url, **params):
+            return [t.summary for t in Client().get(url, params).context['ticket_list']]
+        
+        url = reverse('ticket_list')
+        self.assertEqual(['filtered'], tickets(url, topic=other_topic.id))
+        self.assertEqual(['filtered'], tickets(url, grant='g2', requester='requester', date_from='2011-10-01', date_to='2011-10-31'))
+        self.assertEqual([], tickets(url, grant='g2', payment_status='paid'))
+        self.assertEqual([], tickets(url, date_from='bogus'))
+        self.assertEqual(2, len(tickets(url, topic=self.topic.id)))
+        
+        # requesters without an account are matched by the text shown
+        Ticket.objects.create(summary='text only', topic=other_topic, requested_text='requester')
+        Ticket.objects.create(summary='stale text', topic=other_topic, requested_user=User.objects.create(username='other'), requested_text='requester')
+        self.assertEqual(['filtered', 'text only'], sorted(tickets(url, requester='requester')))
+        self.assertEqual(['foo'], tickets(url, requester='req1'))
+        
+        feed = Client().get(reverse('ticket_list_feed'), {'requester': 'requester'}).content
+        self.assertTrue('filtered' in feed)
+        self.assertFalse('foo' in feed)
+    
     def test_ticket_detail(self):
         response = Client().get(reverse('ticket_detail', kwargs={'pk':self.ticket1.id}))
         self.assertEqual(response.status_code, 200)
@@ -69,15 +148,180 @@ class SimpleTicketTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['topic_list']), 1)
     
+    def test_topic_table_queries(self):
+        Grant.objects.filter(id=self.topic.grant_id).update(slug='g')
+        urls = (reverse('topic_list'), reverse('grant_detail', kwargs={'slug':'g'}))
+        c = Client()
+        for url, queries in zip(urls, (3, 9)):
+            with self.assertNumQueries(queries):
+                c.get(url)
+        
+        for i in range(3):
+            topic = Topic.objects.create(name='topic%d' % (i + 2), grant=self.topic.grant)
+            topic.admin.add(User.objects.create(username='admin%d' % i))
+            Ticket.objects.create(summary='ticket', topic=topic)
+        for url, queries in zip(urls, (3, 9)):
+            with self.assertNumQueries(queries):
+                response = c.get(url)
+            self.assertContains(response, 'admin2')
+    
     def test_javascript_topic_list(self):
         response = Client().get(reverse('topics_js'))
         self.assertEqual(response.status_code, 200)
     
+    def test_javascript_topic_list_caching(self):
+        closed = Topic.objects.create(name='closed', grant=self.topic.grant, form_description='closed one')
+        self.topic.open_for_tickets = True
+        self.topic.save()
+        c = Client()
+        response = c.get(reverse('topics_js'))
+        self.assertContains(response, 'closed one')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(0):
+            response = c.get(reverse('topics_js'), HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+        
+        response = c.get(reverse('topics_js'), {'open': '1'})
+        self.assertNotContains(response, 'closed one')
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertContains(c.get(reverse('topics_js'), {'open': '1', 'topic': closed.id}), 'closed one')
+        # parameters not changing the content share its variant
+        for params in ({'open': 'yes', 'topic': 'x'}, {'open': '1', 'topic': self.topic.id}, {'open': '1', 'topic': 123456}, {'topic': closed.id}):
+            c.get(reverse('topics_js'), params)
+        self.assertEqual(set(['version', (False, None), (True, None), (True, closed.id)]), set(_topics_js.keys()))
+        
+        closed.form_description = 'changed'
+        closed.save()
+        response = c.get(reverse('topics_js'), HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertContains(response, 'changed')
+    
     def test_topic_detail(self):
         response = Client().get(reverse('topic_detail', kwargs={'pk':self.topic.id}))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['topic'].ticket_set.all()), 2)
     
+    def test_topic_detail_pages(self):
+        Topic.objects.filter(id=self.topic.id).update(ticket_media=True, ticket_expenses=True)
+        for day, rating in ((3, 100), (1, 50), (2, None)):
+            ticket = Ticket.objects.create(summary='day %d' % day, topic=self.topic, event_date=datetime.date(2011, 10, day), rating_percentage=rating)
+            ticket.add_acks('content', 'docs', 'archive')
+            Expediture.objects.create(ticket=ticket, description='exp', amount=33)
+            MediaInfo.objects.create(ticket=ticket, description='media', count=day)
+        expected = list(Ticket.objects.order_by('-sort_date', '-id'))
+        
+        # the summary of the whole topic is the same as computed ticket by ticket
+        topic = Topic.summary_queryset().get(id=self.topic.id)
+        plain = Topic.objects.get(id=self.topic.id)
+        self.assertEqual(plain.media_count(), topic.media_count())
+        self.assertEqual(plain.expeditures(), topic.expeditures())
+        self.assertEqual(Decimal('49.50'), plain.accepted_expeditures())
+        self.assertEqual(Decimal('49.50'), topic.accepted_expeditures())
+        
+        # fractions of a cent come out exact as well
+        cents = Topic.objects.create(name='cents', grant=self.topic.grant)
+        for amount, rating in (('0.29', 33), ('0.29', 50), ('10.05', 15)):
+            ticket = Ticket.objects.create(summary='cents', topic=cents, rating_percentage=rating)
+            ticket.add_acks('content', 'docs', 'archive')
+            Expediture.objects.create(ticket=ticket, description='exp', amount=Decimal(amount))
+        self.assertEqual(Decimal('1.7482'), Topic.objects.get(id=cents.id).accepted_expeditures())
+        self.assertEqual(Decimal('1.7482'), Topic.summary_queryset().get(id=cents.id).accepted_expeditures())
+        
+        old_size = settings.TRACKER_TICKETS_PER_PAGE
+        settings.TRACKER_TICKETS_PER_PAGE = 3
+        try:
+            c = Client()
+            url = self.topic.get_absolute_url()
+            response = c.get(url)
+            self.assertEqual(expected[:3], response.context['ticket_list'])
+            self.assertContains(response, '49.50')
+            
+            # lazy loading of the other rows
+            response = c.get(url + response.context['next_page_url'] + '&rows=1')
+            self.assertEqual(expected[3:], response.context['ticket_list'])
+            self.assertContains(response, expected[3].get_absolute_url())
+            self.assertNotContains(response, '<html')
+            self.assertFalse('next_page_url' in response.context)
+        finally:
+            settings.TRACKER_TICKETS_PER_PAGE = old_size
+    
+    def test_ticket_row_cache(self):
+        url = reverse('topic_detail', kwargs={'pk':self.topic.id})
+        c = Client()
+        self.assertContains(c.get(url), 'foo</a>')
+        
+        # rows are only rendered anew once their version changes
+        Ticket.objects.filter(id=self.ticket1.id).update(summary='renamed')
+        self.assertContains(c.get(url), 'foo</a>')
+        version = Ticket.objects.get(id=self.ticket1.id).row_version
+        Expediture.objects.create(ticket=self.ticket1, description='exp', amount=10)
+        self.assertContains(c.get(url), 'renamed</a>')
+        
+        Ticket.objects.filter(id=self.ticket1.id).update(summary='again')
+        self.ticket1.add_acks('content')
+        self.assertContains(c.get(url), 'again</a>')
+        self.assertTrue(Ticket.objects.get(id=self.ticket1.id).row_version > version)
+        
+        # other column sets are cached separately
+        self.assertContains(c.get(reverse('ticket_list')), 'again</a>')
+    
+    def test_conditional_detail_pages(self):
+        c = Client()
+        for url in (self.ticket1.get_absolute_url(), self.topic.get_absolute_url()):
+            etag = c.get(url)['ETag']
+            self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+            self.ticket1.add_acks('content')
+            self.assertEqual(200, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        
+        # topic pages list their administrators
+        url = self.topic.get_absolute_url()
+        etag = c.get(url)['ETag']
+        admin = User.objects.create(username='topicadmin')
+        self.topic.admin.add(admin)
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'topicadmin')
+        User.objects.filter(id=admin.id).update(username='renamed')
+        self.assertContains(c.get(url, HTTP_IF_NONE_MATCH=response['ETag']), 'renamed')
+        # and link their grant, even with no tickets
+        empty_topic = Topic.objects.create(name='empty', grant=Grant.objects.create(full_name='h', short_name='h', slug='h'))
+        url = empty_topic.get_absolute_url()
+        etag = c.get(url)['ETag']
+        Grant.objects.filter(id=empty_topic.grant_id).update(short_name='grant renamed')
+        self.assertContains(c.get(url, HTTP_IF_NONE_MATCH=etag), 'grant renamed')
+        
+        # grant pages show topic summaries only
+        Grant.objects.filter(id=self.topic.grant_id).update(slug='g')
+        url = reverse('grant_detail', kwargs={'slug':'g'})
+        etag = c.get(url)['ETag']
+        self.ticket1.add_acks('docs')
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        Ticket.objects.create(summary='new', topic=self.topic)
+        self.assertEqual(200, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        
+        # the requester sees an edit link others don't
+        User.objects.create_user('user', 'user@example.com', 'pw')
+        Ticket.objects.filter(id=self.ticket1.id).update(requested_user=User.objects.get(username='user'))
+        url = self.ticket1.get_absolute_url()
+        etag = c.get(url)['ETag']
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        c.login(username='user', password='pw')
+        self.assertEqual(200, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        # pages show the user's name and admin link
+        etag = c.get(url)['ETag']
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        User.objects.filter(username='user').update(username='renameduser')
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        User.objects.filter(username='renameduser').update(is_staff=True)
+        self.assertEqual(200, c.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code)
+        
+        # clusters
+        ticket = Ticket.objects.get(id=self.ticket1.id)
+        url = reverse('cluster_detail', kwargs={'pk':ticket.cluster_id})
+        etag = c.get(url)['ETag']
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=10, other_text='x', description='pay').tickets.add(ticket)
+        self.assertEqual(200, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+    
     def test_topic_absolute_url(self):
         t = self.topic
         self.assertEqual(reverse('topic_detail', kwargs={'pk':t.id}), t.get_absolute_url())
@@ -140,6 +384,21 @@ class TicketSumTests(TestCase):
         self.assertEqual({'count': 2, 'amount': 200}, full_ticket.expeditures())
         self.assertEqual({'objects': 3, 'media': 31}, self.topic.media_count())
         self.assertEqual({'count': 2, 'amount': 200}, self.topic.expeditures())
+    
+    def test_ticket_summaries(self):
+        full_ticket = Ticket.objects.create(topic=self.topic, requested_text='someone', summary='full ticket', rating_percentage=50)
+        full_ticket.add_acks('content', 'docs', 'archive')
+        full_ticket.mediainfo_set.create(description='Vague pictures')
+        full_ticket.mediainfo_set.create(description='Counted pictures', count=15)
+        full_ticket.expediture_set.create(description='Some expense', amount='99.50')
+        full_ticket.expediture_set.create(description='Some other expense', amount=101)
+        Ticket.objects.create(topic=self.topic, requested_text='someone', summary='empty ticket')
+        
+        expected = [(t.media_count(), t.expeditures(), t.accepted_expeditures()) for t in Ticket.objects.order_by('id')]
+        with self.assertNumQueries(1):
+            summaries = [(t.media_count(), t.expeditures(), t.accepted_expeditures()) for t in self.topic.ticket_set.with_summaries().order_by('id')]
+        self.assertEqual(expected, summaries)
+        self.assertEqual((Decimal('200.50'), Decimal('100.25')), (summaries[0][1]['amount'], summaries[0][2]))
 
 class TicketTests(TestCase):
     def setUp(self):
@@ -478,7 +737,70 @@ class TicketAckTests(TestCase):
         
         response = c.post(delete_url)
         self.assertRedirects(response, reverse('ticket_detail', kwargs={'pk':self.ticket.id}))
-        self.assertTrue('user_docs' not in self.ticket.ack_set())
+        self.assertTrue('user_docs' not in Ticket.objects.get(id=self.ticket.id).ack_set())
+    
+    def test_ack_mask(self):
+        self.ticket.add_acks('content', 'docs')
+        self.ticket.ticketack_set.create(ack_type='docs') # duplicate type
+        self.ticket.ticketack_set.filter(ack_type='docs')[0].delete()
+        
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(set(['content', 'docs']), ticket.ack_set())
+            self.assertFalse(ticket.has_all_acks('content', 'docs', 'archive'))
+            self.assertEqual(['user_content', 'user_docs'], [a.ack_type for a in ticket.possible_user_acks()])
+            ticket.state_str()
+        
+        # stale instances don't overwrite the mask
+        self.ticket.add_acks('archive')
+        ticket.summary = 'changed'
+        ticket.save()
+        self.assertTrue(Ticket.objects.get(id=ticket.id).has_all_acks('content', 'docs', 'archive'))
+    
+    def test_closed_ticket_state(self):
+        self.ticket.rating_percentage = 100
+        self.ticket.save()
+        self.ticket.add_acks('user_content', 'content', 'user_docs', 'docs', 'archive')
+        self.assertEqual(u'archived', Ticket.objects.get(id=self.ticket.id).state_str())
+        
+        # the close ack takes precedence over any other ack
+        self.ticket.add_acks('close')
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        self.assertEqual('closed', ticket.state)
+        self.assertEqual(u'closed', ticket.state_str())
+        response = Client().get(reverse('ticket_list'), {'state': 'closed'})
+        self.assertEqual([ticket], list(response.context['ticket_list']))
+        
+        self.ticket.ticketack_set.filter(ack_type='close').delete()
+        self.assertEqual(u'archived', Ticket.objects.get(id=self.ticket.id).state_str())
+    
+    def test_ticket_state(self):
+        def state():
+            return Ticket.objects.get(id=self.ticket.id).state
+        self.assertEqual('draft', state())
+        self.ticket.add_acks('user_content')
+        self.assertEqual('waiting_for_approval', state())
+        self.ticket.add_acks('content')
+        self.assertEqual('waiting_for_rating', self.ticket.state)
+        self.assertEqual('waiting_for_rating', state())
+        
+        self.ticket.rating_percentage = 100
+        self.ticket.save()
+        self.assertEqual('waiting_for_documents', state())
+        self.ticket.add_acks('close')
+        self.assertEqual('closed', state())
+        self.assertEqual('closed', Ticket.objects.get(id=self.ticket.id).state_str())
+        
+        self.ticket.custom_state = 'on hold'
+        self.ticket.save()
+        self.assertEqual('custom', state())
+        self.assertEqual('on hold', Ticket.objects.get(id=self.ticket.id).state_str())
+        
+        other = Ticket.objects.create(summary='other', topic=self.topic)
+        response = Client().get(reverse('ticket_list'), {'state': 'draft'})
+        self.assertEqual([other], list(response.context['ticket_list']))
+        response = Client().get(reverse('ticket_list'), {'state': 'nonsense'})
+        self.assertEqual(0, len(response.context['ticket_list']))
     
     def test_ack_not_deletable_by_anon(self):
         self.ticket.add_acks('user_docs')
@@ -563,6 +885,28 @@ class TicketEditLinkTests(TestCase):
         response = self.get_ticket_response()
         self.assertEqual(False, response.context['user_can_edit_ticket'])
         self.assertEqual(True, response.context['user_can_edit_ticket_in_admin'])
+    
+    def test_admin_ticket_list(self):
+        self.user.is_staff = True
+        self.user.save()
+        ticket_content = ContentType.objects.get(app_label='tracker', model='ticket')
+        self.user.user_permissions.add(Permission.objects.get(content_type=ticket_content, codename='change_ticket'))
+        self.user.topic_set.add(self.topic)
+        Ticket.objects.create(summary='hidden', topic=Topic.objects.create(name='other', grant=self.topic.grant))
+        
+        c = Client()
+        c.login(username=self.user.username, password=self.password)
+        url = reverse('admin:tracker_ticket_changelist')
+        with self.assertNumQueries(10):
+            response = c.get(url)
+        self.assertEqual([self.ticket], list(response.context['cl'].result_list))
+        
+        # more rows take no more queries
+        for i in range(5):
+            Ticket.objects.create(summary='more', topic=self.topic, requested_user=User.objects.create(username='requester%d' % i))
+        with self.assertNumQueries(10):
+            response = c.get(url)
+        self.assertEqual(6, len(response.context['cl'].result_list))
 
 class UserDetailsTest(TestCase):
     def setUp(self):
@@ -609,7 +953,7 @@ class SummaryTest(TestCase):
         trans = Transaction.objects.create(date=datetime.date.today(), other=self.user, amount=150)
         trans.tickets.add(self.ticket)
         self.assertEqual({'unpaid':1, 'paid':1}, self.topic.tickets_per_payment_status())
-
+    
     def test_ticket_summary(self):
         self.ticket.ticketack_set.filter(ack_type='archive').delete()
         self.ticket.rating_percentage = None
@@ -625,7 +969,7 @@ class SummaryTest(TestCase):
         
         self.ticket.add_acks('archive')
         self.assertEqual(150, self.ticket.accepted_expeditures())
-
+    
     def test_topic_summary(self):
         self.assertEqual({'objects':3, 'media':13}, self.topic.media_count())
         self.assertEqual({'count':4, 'amount':910}, self.topic.expeditures())
@@ -663,6 +1007,68 @@ class TransactionTest(TestCase):
         response = c.get(reverse('transaction_list'))
         self.assertEqual(200, response.status_code)
         self.assertEqual(600, response.context['total'])
+        # the total of the transactions filtered
+        self.assertEqual(100, c.get(reverse('transaction_list'), {'date_from':'2011-12-25'}).context['total'])
+        self.assertEqual(300, c.get(reverse('transaction_list'), {'date_from':'2011-12-24', 'date_to':'2011-12-25'}).context['total'])
+        self.assertEqual(0, c.get(reverse('transaction_list'), {'date_to':'2011-12-01'}).context['total'])
+        self.assertEqual(0, c.get(reverse('transaction_list'), {'date_to':'bogus'}).context['total'])
+    
+    def test_transactions_feed(self):
+        Transaction.objects.create(date=datetime.date(2011, 12, 27), amount=10, other_text='shop', description='text only')
+        c = Client()
+        url = reverse('transactions_feed')
+        response = c.get(url)
+        self.assertContains(response, 'text only')
+        self.assertContains(response, reverse('transaction_list'))
+        with self.assertNumQueries(0):
+            self.assertEqual(response.content, c.get(url).content)
+        self.assertEqual(304, c.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code)
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code)
+        
+        self.tr.description = 'changed desc'
+        self.tr.save()
+        response = c.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, 'changed desc')
+        
+        # a version lost from the cache starts anew, never older than the one served
+        version = cache.get(FEED_VERSION_CACHE_KEY + ':transactions')
+        cache.delete(FEED_VERSION_CACHE_KEY + ':transactions')
+        c.get(url)
+        self.assertTrue(cache.get(FEED_VERSION_CACHE_KEY + ':transactions') >= version)
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=c.get(url)['ETag']).status_code)
+    
+    def test_transaction_list_pages(self):
+        topic = Topic.objects.create(name='test_topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        ticket = Ticket.objects.create(summary='foo', topic=topic)
+        for day in range(1, 6):
+            Transaction.objects.create(date=datetime.date(2011, 11, day), amount=day, other_text='shop', description='day %d' % day).tickets.add(ticket)
+        
+        old_size = settings.TRACKER_TRANSACTIONS_PER_PAGE
+        settings.TRACKER_TRANSACTIONS_PER_PAGE = 4
+        try:
+            c = Client()
+            c.get(reverse('transaction_list')) # total gets cached
+            with self.assertNumQueries(2):
+                response = c.get(reverse('transaction_list'))
+            self.assertEqual(615, response.context['total'])
+            transactions = response.context['transaction_list']
+            self.assertEqual([datetime.date(2011, 12, day) for day in (26, 25, 24)] + [datetime.date(2011, 11, 5)], [tx.date for tx in transactions])
+            self.assertEqual([ticket], transactions[3].tickets_by_id())
+            self.assertEqual(['g'], [grant.short_name for grant in transactions[3].grant_set()])
+            self.assertEqual([], transactions[0].tickets_by_id())
+            
+            next_url = reverse('transaction_list') + response.context['next_page_url']
+            # the seek has a plain range bound on the date as well
+            sql = executed_sql(c.get, next_url)
+            self.assertTrue([query for query in sql if '"tracker_transaction"."date" <= ' in query])
+            response = c.get(next_url)
+            self.assertEqual(['day 4', 'day 3', 'day 2', 'day 1'], [tx.description for tx in response.context['transaction_list']])
+            self.assertFalse('next_page_url' in response.context)
+            
+            Transaction.objects.create(date=datetime.date(2011, 12, 27), amount=5, other_text='shop', description='another')
+            self.assertEqual(620, c.get(reverse('transaction_list')).context['total'])
+        finally:
+            settings.TRACKER_TRANSACTIONS_PER_PAGE = old_size
     
     def test_transactions_csv(self):
         c = Client()
@@ -675,6 +1081,34 @@ class TransactionTest(TestCase):
             + "2011-12-25;user;-200.00;other;;;\r\n"
             + "2011-12-24;user;500.00;some desc;;;\r\n", response.content)
     
+    def test_transactions_csv_chunks(self):
+        topic = Topic.objects.create(name='test_topic', grant=Grant.objects.create(full_name='g', short_name='g'))
+        other_topic = Topic.objects.create(name='other_topic', grant=Grant.objects.create(full_name='h', short_name='h'))
+        ticket = Ticket.objects.create(summary='foo', topic=topic)
+        other_ticket = Ticket.objects.create(summary='bar', topic=other_topic)
+        self.tr.tickets.add(ticket, other_ticket)
+        Transaction.objects.create(date=datetime.date(2011, 12, 25), amount=10, other_text='shop; ltd', description='text only').tickets.add(ticket)
+        
+        def fields(lines):
+            return [line.split(';')[:2] + line.split(';')[3:] for line in ''.join(lines).split('\r\n')[1:-1]]
+        expected = [
+            ['2011-12-26', 'user2', 'user2', '', '', ''],
+            ['2011-12-25', 'shop, ltd', 'text only', str(ticket.id), 'g', ''],
+            ['2011-12-25', 'user', 'other', '', '', ''],
+            ['2011-12-24', 'user', 'some desc', '%d %d' % (ticket.id, other_ticket.id), 'g h', ''],
+        ]
+        lines = []
+        sql = executed_sql(lambda: lines.extend(transaction_csv_lines(Transaction.objects.all(), chunk_size=2)))
+        self.assertEqual(expected, fields(lines))
+        # chunks after the first seek by a plain range bound on the date as well
+        self.assertTrue([query for query in sql if '"tracker_transaction"."date" <= ' in query])
+        
+        c = Client()
+        response = c.get(reverse('transactions_csv'), {'date_from': '2011-12-25', 'date_to': '2011-12-25'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(expected[1:3], fields([response.content]))
+        self.assertEqual(400, c.get(reverse('transactions_csv'), {'date_from': 'yesterday'}).status_code)
+    
     def test_user_list(self):
         topic = Topic.objects.create(name='test_topic', ticket_expenses=True, grant=Grant.objects.create(full_name='g', short_name='g'))
         ticket = Ticket.objects.create(summary='foo', requested_user=self.user2, topic=topic, rating_percentage=100)
@@ -703,6 +1137,32 @@ class TransactionTest(TestCase):
             'accepted_expeditures': 0,
         }
         self.assertEqual(expected_unassigned, response.context['unassigned'])
+    
+    def test_user_list_pages(self):
+        topic = Topic.objects.create(name='test_topic', ticket_expenses=True, grant=Grant.objects.create(full_name='g', short_name='g'))
+        for i in range(5):
+            user = User.objects.create(username='member%d' % i)
+            ticket = Ticket.objects.create(summary='foo', requested_user=user, topic=topic, rating_percentage=50)
+            ticket.add_acks('content', 'docs', 'archive')
+            ticket.expediture_set.create(description='exp', amount=100)
+        
+        old_size = settings.TRACKER_USERS_PER_PAGE
+        settings.TRACKER_USERS_PER_PAGE = 3
+        try:
+            c = Client()
+            with self.assertNumQueries(6):
+                response = c.get(reverse('user_list'))
+            self.assertEqual(['user', 'user2', 'member0'], [row['user'].username for row in response.context['user_list']])
+            self.assertEqual(300, response.context['user_list'][0]['transactions']['amount'])
+            self.assertEqual(50, response.context['user_list'][2]['accepted_expeditures'])
+            
+            response = c.get(reverse('user_list') + '?page=3')
+            self.assertEqual(['member4'], [row['user'].username for row in response.context['user_list']])
+            self.assertEqual(5, response.context['totals']['ticket_count'])
+            self.assertEqual(250, response.context['totals']['accepted_expeditures'])
+            self.assertEqual(404, c.get(reverse('user_list') + '?page=4').status_code)
+        finally:
+            settings.TRACKER_USERS_PER_PAGE = old_size
 
 class ClusterTest(TestCase):
     def setUp(self):
@@ -833,7 +1293,7 @@ class ClusterTest(TestCase):
         self.assertEqual('overpaid', Ticket.objects.get(id=tid2).payment_status)
         self.assertEqual(FinanceStatus(paid=300, overpaid=5), self.topic.payment_summary())
         self.assertEqual({'unpaid':0, 'paid':300, 'overpaid':5}, Cluster.cluster_sums())
-
+    
     def test_cluster_transaction_delete(self):
         ticket = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
         ticket.add_acks('content', 'docs', 'archive')
@@ -858,6 +1318,51 @@ class ClusterTest(TestCase):
         self.assertEqual(FinanceStatus(paid=100), self.topic.payment_summary())
         self.assertEqual({'unpaid':0, 'paid':100, 'overpaid':0}, Cluster.cluster_sums())
     
+    def test_cluster_detail(self):
+        other_topic = Topic.objects.create(name='other_topic', ticket_expenses=True, grant=self.topic.grant)
+        tickets = [Ticket.objects.create(summary='t%d' % i, topic=self.topic) for i in range(3)]
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay')
+        tr.tickets.add(*tickets)
+        cluster = Cluster.objects.get(id=tickets[0].id)
+        self.assertEqual((3, 1, 1), (cluster.ticket_count, cluster.transaction_count, cluster.topic_count))
+        
+        # moving a ticket to another topic recounts the topics
+        tickets[2].topic = other_topic
+        tickets[2].save()
+        self.assertEqual(2, Cluster.objects.get(id=cluster.id).topic_count)
+        self.assertEqual([], list(check_clusters()))
+        
+        old_size = settings.TRACKER_TICKETS_PER_PAGE
+        settings.TRACKER_TICKETS_PER_PAGE = 2
+        try:
+            c = Client()
+            url = reverse('cluster_detail', kwargs={'pk':cluster.id})
+            response = c.get(url)
+            self.assertEqual([tickets[2], tickets[1]], response.context['ticket_list'])
+            self.assertEqual([tr], response.context['transaction_page'].object_list)
+            response = c.get(url, {'tickets': 2, 'transactions': 1})
+            self.assertEqual([tickets[0]], response.context['ticket_list'])
+            self.assertEqual(404, c.get(url, {'tickets': 3}).status_code)
+            
+            # the ETag reads only the rows of the pages shown; the CSRF token
+            # is part of it, so the client needs a stable one
+            c.cookies[settings.CSRF_COOKIE_NAME] = 'token'
+            etag = c.get(url)['ETag']
+            with self.assertNumQueries(4):
+                self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+            Ticket.objects.filter(id=tickets[1].id).update(row_version=F('row_version') + 1)
+            response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, response.status_code)
+            Transaction.objects.filter(id=tr.id).update(description='changed')
+            self.assertContains(c.get(url, HTTP_IF_NONE_MATCH=response['ETag']), 'changed')
+        finally:
+            settings.TRACKER_TICKETS_PER_PAGE = old_size
+        
+        # ticket ids lead to the ticket's cluster
+        with self.assertNumQueries(3):
+            response = c.get(reverse('cluster_detail', kwargs={'pk':tickets[1].id}))
+        self.assertRedirects(response, url)
+    
     def test_cluster_ticket_delete(self):
         ticket1 = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
         ticket1.add_acks('content', 'docs', 'archive')
@@ -910,6 +1415,447 @@ class ClusterTest(TestCase):
         self.assertEqual(FinanceStatus(fuzzy=True, unpaid=60, paid=50), self.topic.payment_summary())
         self.assertEqual(FinanceStatus(fuzzy=True, unpaid=60, paid=50), another_topic.payment_summary())
         self.assertEqual({'unpaid':120, 'paid':100, 'overpaid':0}, Cluster.cluster_sums())
+    
+    def test_finance_for_topics(self):
+        another_topic = Topic.objects.create(name='another_topic', ticket_expenses=True, grant=self.topic.grant)
+        def ticket(topic, amount, rating=100, acks=('content', 'docs', 'archive')):
+            ticket = Ticket.objects.create(summary='t', topic=topic, rating_percentage=rating)
+            ticket.add_acks(*acks)
+            Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=amount)
+            return ticket
+        def pay(amount, *tickets):
+            Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=amount, other=self.user, description='pay').tickets.add(*tickets)
+        
+        ticket(self.topic, 100) # unpaid
+        ticket(self.topic, '33.33', rating=33) # unpaid, rated
+        ticket(another_topic, 100, acks=('content', )) # n/a
+        pay(100, ticket(another_topic, 100)) # paid
+        pay(150, ticket(self.topic, 100)) # overpaid
+        pay(10, ticket(self.topic, 20), ticket(another_topic, 10), ticket(another_topic, 10)) # partially paid, fuzzy
+        
+        expected = {}
+        for t in Ticket.objects.all():
+            expected.setdefault(t.topic_id, FinanceStatus()).add_ticket(t)
+        with self.assertNumQueries(2):
+            finances = FinanceStatus.for_topics()
+        self.assertEqual(expected, finances)
+        self.assertEqual(FinanceStatus(fuzzy=True, unpaid=Decimal('125.9989'), paid=105, overpaid=50), finances[self.topic.id])
+        self.assertEqual(expected[another_topic.id], another_topic.payment_summary())
+        
+        # the page reads the snapshot, stored in cents
+        response = Client().get(reverse('topic_finance'))
+        self.assertEqual(FinanceStatus(fuzzy=True, unpaid=Decimal('126.00'), paid=105, overpaid=50), response.context['grants'][0]['topics'][1]['finance'])
+    
+    def test_finance_snapshot(self):
+        def check_snapshot():
+            stored = dict([((row.topic_id, row.grant_id), row.values()) for row in FinanceSnapshot.objects.all()])
+            self.assertEqual(FinanceSnapshot.compute(), stored)
+        
+        grant = self.topic.grant
+        other_grant = Grant.objects.create(full_name='g2', short_name='g2', slug='g2')
+        another_topic = Topic.objects.create(name='another_topic', grant=grant)
+        ticket = Ticket.objects.create(summary='ticket', topic=self.topic, rating_percentage=100)
+        ticket.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+        other = Ticket.objects.create(summary='other', topic=another_topic, rating_percentage=100)
+        other.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=other.id, description='exp', amount=50)
+        check_snapshot()
+        self.assertEqual({'unpaid':150, 'paid':0, 'overpaid':0}, Cluster.cluster_sums())
+        self.assertEqual(Decimal(150), FinanceSnapshot.objects.get(topic_id=None, grant_id=grant.id).unpaid)
+        
+        Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay').tickets.add(ticket)
+        check_snapshot()
+        self.assertEqual({'paid':1}, self.topic.tickets_per_payment_status())
+        
+        # ticket moving to another topic, topic moving to another grant
+        other.topic = self.topic
+        other.save()
+        check_snapshot()
+        self.assertEqual({'paid':1, 'unpaid':1}, self.topic.tickets_per_payment_status())
+        self.topic.grant = other_grant
+        self.topic.save()
+        check_snapshot()
+        self.assertEqual(2, FinanceSnapshot.objects.get(topic_id=None, grant_id=other_grant.id).tickets)
+        self.assertEqual(0, FinanceSnapshot.objects.get(topic_id=None, grant_id=grant.id).tickets)
+        
+        other.delete()
+        check_snapshot()
+        another_topic.delete()
+        check_snapshot()
+        
+        FinanceSnapshot.objects.filter(topic_id=self.topic.id).update(paid=1)
+        out = StringIO()
+        call_command('finance_snapshot', stdout=out, verbosity=0)
+        self.assertTrue(out.getvalue().startswith('topic %d: paid 1' % self.topic.id))
+        self.assertTrue(out.getvalue().endswith(' != 100.00\n'))
+        out = StringIO()
+        call_command('finance_snapshot', rebuild=True, stdout=out, verbosity=0)
+        self.assertEqual('', out.getvalue())
+        
+        # with no snapshot yet (eg. right after the migration), refreshing
+        # some grants builds all of it
+        FinanceSnapshot.objects.all().delete()
+        FinanceSnapshot.refresh([grant.id])
+        check_snapshot()
+        
+        # rows missing otherwise are computed rather than read as zeros
+        FinanceSnapshot.objects.filter(topic_id=self.topic.id).delete()
+        self.assertEqual({'paid':1}, Topic.objects.get(id=self.topic.id).tickets_per_payment_status())
+        check_snapshot()
+        FinanceSnapshot.objects.filter(topic_id=None, grant_id=other_grant.id).delete()
+        self.assertEqual(1, FinanceSnapshot.load()[(None, other_grant.id)].tickets)
+        check_snapshot()
+    
+    def test_live_cluster_sums_missing_totals(self):
+        for i, (tickets, transactions) in enumerate([(100, None), (None, 30), (None, -10), (None, None), (-5, None), (40, 25), (10, 15)]):
+            Cluster.objects.create(id=1000 + i, more_tickets=False, total_tickets=tickets, total_transactions=transactions)
+        
+        # as counted by cluster, with a missing total being 0
+        expected = {'unpaid':0, 'paid':0, 'overpaid':0}
+        for cluster in Cluster.objects.all():
+            tickets, transactions = cluster.total_tickets or 0, cluster.total_transactions or 0
+            expected['paid'] += min(tickets, transactions)
+            expected['unpaid'] += max(tickets - transactions, 0)
+            expected['overpaid'] += max(transactions - tickets, 0)
+        self.assertEqual({'unpaid':125, 'paid':20, 'overpaid':40}, expected)
+        self.assertEqual(expected, Cluster.live_cluster_sums())
+    
+    def test_refresh_all(self):
+        tickets = []
+        for i in range(4):
+            ticket = Ticket.objects.create(summary='t%d' % i, topic=self.topic, rating_percentage=100)
+            ticket.add_acks('content', 'docs', 'archive')
+            Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+            tickets.append(ticket)
+        tr1 = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=150, other=self.user, description='pay1')
+        tr1.tickets.add(tickets[0], tickets[1])
+        tr2 = Transaction.objects.create(date=datetime.date(2011, 12, 25), amount=100, other=self.user, description='pay2')
+        tr2.tickets.add(tickets[1], tickets[2])
+        tr3 = Transaction.objects.create(date=datetime.date(2011, 12, 26), amount=10, other=self.user, description='loose')
+        
+        def snapshot():
+            return (
+                sorted(Ticket.objects.values_list('id', 'cluster', 'payment_status')),
+                sorted(Transaction.objects.values_list('id', 'cluster')),
+                sorted(Cluster.objects.values_list('id', 'more_tickets', 'total_tickets', 'total_transactions')),
+            )
+        expected = snapshot()
+        self.assertEqual(tickets[0].id, Ticket.objects.get(id=tickets[2].id).cluster_id)
+        self.assertEqual(tickets[3].id, Ticket.objects.get(id=tickets[3].id).cluster_id)
+        self.assertEqual(None, Transaction.objects.get(id=tr3.id).cluster_id)
+        
+        Cluster.objects.all().delete()
+        Ticket.objects.update(payment_status='n_a')
+        ClusterUpdate.refresh_all()
+        self.assertEqual(expected, snapshot())
+    
+    def test_partitions(self):
+        graph = ClusterGraph()
+        # ticket 2 is still stored in cluster 1, which ticket 1 would rewrite
+        graph.tickets = {1: (None, 'n_a'), 2: (1, 'paid'), 3: (3, 'paid'), 4: (None, 'n_a')}
+        graph.transactions = {5: (3, 100), 6: (None, 100)}
+        graph.links = set([(3, 5), (4, 6)])
+        key = lambda group: (sorted(group.tickets), sorted(group.transactions))
+        self.assertEqual([([1], []), ([2], []), ([3], [5]), ([4], [6])], sorted(map(key, graph.components())))
+        self.assertEqual([([1, 2], []), ([3], [5]), ([4], [6])], sorted(map(key, graph.partitions())))
+    
+    def test_refresh_clusters_command(self):
+        tickets = []
+        for i in range(3):
+            ticket = Ticket.objects.create(summary='t%d' % i, topic=self.topic, rating_percentage=100)
+            ticket.add_acks('content', 'docs', 'archive')
+            Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+            tickets.append(ticket)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=200, other=self.user, description='pay')
+        tr.tickets.add(tickets[0], tickets[1])
+        Cluster.objects.update(total_tickets=0)
+        Ticket.objects.update(payment_status='n_a')
+        
+        out = StringIO()
+        call_command('refresh_clusters', dry_run=True, stdout=out)
+        self.assertTrue('ticket %d: payment status n_a -> paid' % tickets[1].id in out.getvalue())
+        self.assertEqual(0, Ticket.objects.filter(payment_status='paid').count())
+        
+        # partitions listed in the checkpoint are skipped; a finished run removes it
+        checkpoint = tempfile.mktemp()
+        open(checkpoint, 'w').write(partition_key(ClusterGroup(set([tickets[2].id]))) + '\n')
+        call_command('refresh_clusters', checkpoint=checkpoint, batch_size=1, stdout=StringIO())
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual('paid', Ticket.objects.get(id=tickets[1].id).payment_status)
+        self.assertEqual(200, Cluster.objects.get(id=tickets[0].id).total_tickets)
+        self.assertEqual('n_a', Ticket.objects.get(id=tickets[2].id).payment_status)
+        
+        call_command('refresh_clusters', stdout=StringIO())
+        self.assertEqual('unpaid', Ticket.objects.get(id=tickets[2].id).payment_status)
+        self.assertTrue(ClusterUpdate.refresh_all().is_empty())
+        
+        # a run with nothing left to change still refreshes the snapshot,
+        # which an interrupted run may have left behind
+        FinanceSnapshot.objects.filter(topic_id__isnull=True, grant_id__isnull=True).update(paid=0, tickets_paid=0)
+        call_command('refresh_clusters', stdout=StringIO())
+        total = FinanceSnapshot.objects.get(topic_id__isnull=True, grant_id__isnull=True)
+        self.assertEqual((200, 2), (total.paid, total.tickets_paid))
+    
+    def test_check_clusters(self):
+        tickets = []
+        for i in range(3):
+            ticket = Ticket.objects.create(summary='t%d' % i, topic=self.topic, rating_percentage=100)
+            ticket.add_acks('content', 'docs', 'archive')
+            Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+            tickets.append(ticket)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=200, other=self.user, description='pay')
+        tr.tickets.add(tickets[0], tickets[1])
+        self.assertEqual([], list(check_clusters(chunk_size=1)))
+        
+        Cluster.objects.filter(id=tickets[0].id).update(total_tickets=150)
+        Ticket.objects.filter(id=tickets[2].id).update(payment_status='paid')
+        Transaction.tickets.through.objects.create(ticket=tickets[2], transaction=tr)
+        found = sorted([(d['check'], d['repair']['tickets'], d['repair']['transactions']) for d in check_clusters(chunk_size=1)])
+        self.assertEqual([
+            ('link_across_clusters', [tickets[2].id], [tr.id]),
+            ('payment_status', [tickets[2].id], []),
+            ('total_tickets', [tickets[0].id], []),
+        ], found)
+        
+        out, repair_list = StringIO(), tempfile.mktemp()
+        call_command('verify_clusters', repair_list=repair_list, verbosity=0, stdout=out)
+        self.assertEqual(3, len(out.getvalue().splitlines()))
+        self.assertEqual(['ticket %d' % tickets[0].id, 'ticket %d' % tickets[2].id, 'ticket %d' % tickets[2].id, 'transaction %d' % tr.id],
+            sorted(open(repair_list).read().splitlines()))
+        os.remove(repair_list)
+        
+        ClusterUpdate.perform(ticket_ids=[tickets[0].id, tickets[2].id], transaction_ids=[tr.id])
+        self.assertEqual([], list(check_clusters()))
+        
+        # references to clusters that no longer exist
+        lone = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=10, other=self.user, description='lone')
+        missing = Cluster.objects.order_by('-id')[0].id + 100
+        Ticket.objects.filter(id=tickets[1].id).update(cluster=missing)
+        Transaction.objects.filter(id=lone.id).update(cluster=missing)
+        dangling = [(d['check'], d['found'], d['repair']['tickets'], d['repair']['transactions']) for d in check_clusters(chunk_size=1) if d['check'] == 'dangling_cluster']
+        self.assertEqual([('dangling_cluster', missing, [tickets[1].id], []), ('dangling_cluster', missing, [], [lone.id])], dangling)
+        
+        call_command('verify_clusters', repair_list=repair_list, verbosity=0, stdout=StringIO())
+        self.assertTrue('ticket %d' % tickets[1].id in open(repair_list).read().splitlines())
+        self.assertTrue('transaction %d' % lone.id in open(repair_list).read().splitlines())
+        os.remove(repair_list)
+        ClusterUpdate.perform(ticket_ids=[tickets[1].id], transaction_ids=[lone.id])
+        self.assertEqual([], list(check_clusters()))
+    
+    def test_cluster_update_status(self):
+        ticket = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
+        ticket.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+        Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay').tickets.add(ticket)
+        Cluster.objects.filter(id=ticket.id).update(total_tickets=0, ticket_count=5)
+        Ticket.objects.filter(id=ticket.id).update(payment_status='overpaid')
+        
+        Cluster.objects.get(id=ticket.id).update_status()
+        cluster = Cluster.objects.get(id=ticket.id)
+        self.assertEqual((100, 1), (cluster.total_tickets, cluster.ticket_count))
+        self.assertEqual('paid', Ticket.objects.get(id=ticket.id).payment_status)
+    
+    def test_unchanged_cluster_not_written(self):
+        ticket = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
+        ticket.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=40, other=self.user, description='pay')
+        tr.tickets.add(ticket)
+        
+        self.assertTrue(ClusterUpdate.perform(ticket_ids=set([ticket.id])).is_empty())
+        self.assertTrue(ClusterUpdate.refresh_all().is_empty())
+        
+        Transaction.objects.filter(id=tr.id).update(amount=100)
+        changes = ClusterUpdate.perform(transaction_ids=set([tr.id]))
+        self.assertEqual({ticket.id: {'total_transactions': 100}}, changes.changed_clusters)
+        self.assertEqual({'paid': set([ticket.id])}, changes.ticket_statuses)
+        self.assertEqual({}, changes.ticket_moves)
+        self.assertEqual('paid', Ticket.objects.get(id=ticket.id).payment_status)
+    
+    def test_coalesced_updates(self):
+        middleware = ClusterUpdateMiddleware()
+        ticket1 = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
+        ticket1.add_acks('content', 'docs', 'archive')
+        ticket2 = Ticket.objects.create(summary='two', topic=self.topic, rating_percentage=100)
+        ticket2.add_acks('content', 'docs', 'archive')
+        
+        middleware.process_request(None)
+        Expediture.objects.create(ticket_id=ticket1.id, description='exp', amount=100)
+        Expediture.objects.create(ticket_id=ticket2.id, description='exp', amount=50)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=150, other=self.user, description='pay')
+        tr.tickets.add(ticket1, ticket2)
+        # nothing is recomputed until the response is processed
+        self.assertEqual('n_a', Ticket.objects.get(id=ticket1.id).payment_status)
+        self.assertEqual(None, Transaction.objects.get(id=tr.id).cluster)
+        response = HttpResponse()
+        self.assertTrue(response is middleware.process_response(None, response))
+        
+        self.assertEqual('paid', Ticket.objects.get(id=ticket1.id).payment_status)
+        self.assertEqual('paid', Ticket.objects.get(id=ticket2.id).payment_status)
+        self.assertEqual(ticket1.id, Transaction.objects.get(id=tr.id).cluster.id)
+        
+        middleware.process_request(None)
+        ticket1.delete()
+        middleware.process_response(None, HttpResponse())
+        self.assertEqual('overpaid', Ticket.objects.get(id=ticket2.id).payment_status)
+        self.assertEqual(ticket2.id, Ticket.objects.get(id=ticket2.id).cluster.id)
+        self.assertEqual([ticket2.id], list(Cluster.objects.values_list('id', flat=True)))
+    
+    def test_coalesced_updates_failed_request(self):
+        middleware = ClusterUpdateMiddleware()
+        ticket = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
+        ticket.add_acks('content', 'docs', 'archive')
+        
+        # the update of a failed request is dropped with its changes
+        status = Ticket.objects.get(id=ticket.id).payment_status
+        middleware.process_request(None)
+        Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+        self.assertEqual(None, middleware.process_exception(None, ValueError()))
+        middleware.process_response(None, HttpResponse())
+        self.assertEqual(status, Ticket.objects.get(id=ticket.id).payment_status)
+        
+        # a batch left open by a request that never got a response does not
+        # swallow the updates of the next one
+        middleware.process_request(None)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay')
+        tr.tickets.add(ticket)
+        middleware.process_request(None)
+        self.assertEqual('paid', Ticket.objects.get(id=ticket.id).payment_status)
+        Expediture.objects.create(ticket_id=ticket.id, description='more', amount=20)
+        middleware.process_response(None, HttpResponse())
+        self.assertEqual('partially_paid', Ticket.objects.get(id=ticket.id).payment_status)
+    
+    def test_coalesced_updates_block(self):
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=150, other=self.user, description='pay')
+        performed = []
+        perform_now = ClusterUpdate.perform_now
+        def counting_perform_now(ticket_ids=None, transaction_ids=None):
+            performed.append((set(ticket_ids or ()), set(transaction_ids or ())))
+            return perform_now(ticket_ids, transaction_ids)
+        ClusterUpdate.perform_now = staticmethod(counting_perform_now)
+        try:
+            with coalesced_updates():
+                tickets = []
+                for i in range(3):
+                    ticket = Ticket.objects.create(summary='t%d' % i, topic=self.topic, rating_percentage=100)
+                    ticket.add_acks('content', 'docs', 'archive')
+                    Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=50)
+                    tr.tickets.add(ticket)
+                    tickets.append(ticket)
+                self.assertEqual([], performed)
+            self.assertEqual(1, len(performed))
+            self.assertEqual(set([ticket.id for ticket in tickets]), performed[0][0])
+            
+            # an exception drops the collected update
+            try:
+                with coalesced_updates():
+                    Expediture.objects.create(ticket_id=tickets[0].id, description='more', amount=50)
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(1, len(performed))
+        finally:
+            ClusterUpdate.perform_now = staticmethod(perform_now)
+        self.assertEqual(['paid'] * 3, [Ticket.objects.get(id=ticket.id).payment_status for ticket in tickets])
+        self.assertEqual(3, Cluster.objects.get(id=tickets[0].id).ticket_count)
+    
+    def test_total_deltas(self):
+        ticket1 = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=50)
+        ticket1.add_acks('content', 'docs', 'archive')
+        exp = Expediture.objects.create(ticket_id=ticket1.id, description='exp', amount=100)
+        ticket2 = Ticket.objects.create(summary='two', topic=self.topic, rating_percentage=100)
+        ticket2.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=ticket2.id, description='exp', amount=100)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=150, other=self.user, description='pay')
+        tr.tickets.add(ticket1, ticket2)
+        self.assertEqual('paid', Ticket.objects.get(id=ticket2.id).payment_status)
+        
+        def cluster():
+            return Cluster.objects.get(id=ticket1.id)
+        
+        # amount change is applied to the stored total
+        exp.amount = 120
+        exp.save()
+        self.assertEqual(160, cluster().total_tickets)
+        self.assertEqual('partially_paid', Ticket.objects.get(id=ticket2.id).payment_status)
+        
+        # rating change as well
+        ticket1 = Ticket.objects.get(id=ticket1.id)
+        ticket1.rating_percentage = 25
+        ticket1.save()
+        self.assertEqual(130, cluster().total_tickets)
+        self.assertEqual('overpaid', Ticket.objects.get(id=ticket2.id).payment_status)
+        
+        # and so are acks and deleted expeditures
+        ticket2.ticketack_set.filter(ack_type='archive').delete()
+        self.assertEqual(30, cluster().total_tickets)
+        ticket2.add_acks('archive')
+        exp.delete()
+        self.assertEqual(100, cluster().total_tickets)
+        self.assertEqual({ticket1.id: 0, ticket2.id: 100}, ticket_totals([ticket1.id, ticket2.id]))
+        
+        # incremental results equal a full recount
+        self.assertTrue(ClusterUpdate.refresh_all().is_empty())
+    
+    def test_batched_total_deltas(self):
+        middleware = ClusterUpdateMiddleware()
+        ticket1 = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=50)
+        ticket1.add_acks('content', 'docs', 'archive')
+        exp1 = Expediture.objects.create(ticket_id=ticket1.id, description='exp', amount=100)
+        ticket2 = Ticket.objects.create(summary='two', topic=self.topic, rating_percentage=50)
+        ticket2.add_acks('content', 'docs', 'archive')
+        exp2 = Expediture.objects.create(ticket_id=ticket2.id, description='exp', amount=100)
+        tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay')
+        tr.tickets.add(ticket1, ticket2)
+        self.assertEqual('paid', Ticket.objects.get(id=ticket2.id).payment_status)
+        # only a full recount would fix this one
+        Cluster.objects.filter(id=ticket1.id).update(ticket_count=7)
+        
+        middleware.process_request(None)
+        exp1.amount = 150
+        exp1.save()
+        exp1.amount = Decimal('100.01')
+        exp1.save()
+        exp2.amount = Decimal('120.01')
+        exp2.save()
+        # nothing is applied until the response is processed
+        self.assertEqual(100, Cluster.objects.get(id=ticket1.id).total_tickets)
+        middleware.process_response(None, HttpResponse())
+        
+        # the half cent differences sum up to an exact one applied as a delta
+        cluster = Cluster.objects.get(id=ticket1.id)
+        self.assertEqual(Decimal('110.01'), cluster.total_tickets)
+        self.assertEqual(7, cluster.ticket_count)
+        self.assertEqual('partially_paid', Ticket.objects.get(id=ticket2.id).payment_status)
+        
+        Cluster.objects.filter(id=ticket1.id).update(ticket_count=2)
+        self.assertTrue(ClusterUpdate.refresh_all().is_empty())
+    
+    def test_queued_updates(self):
+        ticket = Ticket.objects.create(summary='one', topic=self.topic, rating_percentage=100)
+        ticket.add_acks('content', 'docs', 'archive')
+        Expediture.objects.create(ticket_id=ticket.id, description='exp', amount=100)
+        self.assertEqual('unpaid', Ticket.objects.get(id=ticket.id).payment_status)
+        
+        settings.TRACKER_CLUSTER_UPDATE_QUEUE = True
+        try:
+            tr = Transaction.objects.create(date=datetime.date(2011, 12, 24), amount=100, other=self.user, description='pay')
+            tr.tickets.add(ticket)
+            ticket = Ticket.objects.get(id=ticket.id)
+            self.assertEqual('unpaid', ticket.payment_status)
+            self.assertTrue(ticket.cluster_update_pending)
+            self.assertEqual(2, ClusterUpdateJob.objects.count()) # transaction save + link
+            
+            self.assertEqual(2, ClusterUpdate.process_queue())
+            self.assertEqual(0, ClusterUpdate.process_queue())
+        finally:
+            settings.TRACKER_CLUSTER_UPDATE_QUEUE = False
+        
+        ticket = Ticket.objects.get(id=ticket.id)
+        self.assertEqual('paid', ticket.payment_status)
+        self.assertFalse(ticket.cluster_update_pending)
+        self.assertEqual(0, ClusterUpdateJob.objects.count())
 
 class UserProfileTests(TestCase):
     def test_simple_create(self):
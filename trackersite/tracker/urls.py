@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls.defaults import patterns, include, url
-from django.views.generic import DetailView, ListView, RedirectView
+from django.views.generic import RedirectView
 
-from tracker.models import Ticket, Topic, Grant
 from tracker.feeds import LatestTicketsFeed, TopicTicketsFeed, TransactionsFeed
 
 urlpatterns = patterns('',
-    url(r'^tickets/$', ListView.as_view(model=Ticket), name='ticket_list'),
+    url(r'^tickets/$', 'tracker.views.ticket_list', name='ticket_list'),
     url(r'^tickets/feed/$', LatestTicketsFeed(), name='ticket_list_feed'),
     url(r'^ticket/(?P<pk>\d+)/$', 'tracker.views.ticket_detail', name='ticket_detail'),
     url(r'^ticket/(?P<pk>\d+)/edit/$', 'tracker.views.edit_ticket', name='edit_ticket'),
@@ -15,11 +14,11 @@ urlpatterns = patterns('',
     url(r'^ticket/(?P<pk>\d+)/edit/acks/(?P<ack_id>\d+)/delete/$', 'tracker.views.ticket_ack_delete', name='ticket_ack_delete'),
     url(r'^ticket/(?P<ticket_id>\d+)/docs/(?P<filename>[-_\.A-Za-z0-9]+\.[A-Za-z0-9]+)$', 'tracker.views.download_document', name='download_document'),
     url(r'^ticket/new/$', 'tracker.views.create_ticket', name='create_ticket'),
-    url(r'^topics/$', ListView.as_view(model=Topic), name='topic_list'),
+    url(r'^topics/$', 'tracker.views.topic_list', name='topic_list'),
     url(r'^topics/finance/$', 'tracker.views.topic_finance', name='topic_finance'),
     url(r'^topic/(?P<pk>\d+)/$', 'tracker.views.topic_detail', name='topic_detail'),
     url(r'^topic/(?P<pk>\d+)/feed/$', TopicTicketsFeed(), name='topic_ticket_feed'),
-    url(r'^grant/(?P<slug>[-\w]+)/$', DetailView.as_view(model=Grant), name='grant_detail'),
+    url(r'^grant/(?P<slug>[-\w]+)/$', 'tracker.views.grant_detail', name='grant_detail'),
     url(r'^users/$', 'tracker.views.user_list', name='user_list'),
     url(r'^users/(?P<username>[^/]+)/$', 'tracker.views.user_detail', name='user_detail'),
     url(r'^my/details/$', 'tracker.views.user_details_change', name='user_details_change'),
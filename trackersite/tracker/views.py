@@ -1,25 +1,32 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
 
 from django.db import models
+from django.db.models.fields import BLANK_CHOICE_DASH
 from django.db.models import Q
 from django import forms
 from django.forms.models import fields_for_model, inlineformset_factory, BaseInlineFormSet
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.shortcuts import render, get_object_or_404
-from django.contrib import messages
+from django.contrib import messages, comments
+from django.contrib.contenttypes.models import ContentType
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, Http404
 from django.utils.functional import curry, lazy
 from django.utils.translation import ugettext as _, ugettext_lazy
+from django.utils import translation
 from django.views.generic import ListView, DetailView, FormView, DeleteView
 from django.contrib.admin import widgets as adminwidgets
 from django.conf import settings
 from django.utils import simplejson as json
 from django.core.urlresolvers import reverse
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.views.decorators.http import condition
 from sendfile import sendfile
 
-from tracker.models import Ticket, Topic, Grant, FinanceStatus, MediaInfo, Expediture, Transaction, Cluster, UserProfile, Document, TicketAck
+from tracker.models import Ticket, Topic, Grant, FinanceSnapshot, MediaInfo, Expediture, Transaction, Cluster, UserProfile, Document, TicketAck, TICKET_STATES, PAYMENT_STATUS_CHOICES, topic_form_data
+from tracker.clusters import CHUNK_SIZE
 
 class CommentPostedCatcher(object):
     """ 
@@ -32,20 +39,181 @@ class CommentPostedCatcher(object):
             return HttpResponseRedirect(request.path)
         return super(CommentPostedCatcher, self).get(request, **kwargs)
 
+class TicketFilterForm(forms.Form):
+    """ Ticket list filters, taken from the query string. """
+    topic = forms.ModelChoiceField(queryset=Topic.objects.all(), required=False, label=ugettext_lazy('Topic'))
+    grant = forms.ModelChoiceField(queryset=Grant.objects.all(), to_field_name='slug', required=False, label=ugettext_lazy('Grant'))
+    state = forms.ChoiceField(choices=BLANK_CHOICE_DASH + list(TICKET_STATES), required=False, label=ugettext_lazy('State'))
+    payment_status = forms.ChoiceField(choices=BLANK_CHOICE_DASH + list(PAYMENT_STATUS_CHOICES), required=False, label=ugettext_lazy('Payment status'))
+    requester = forms.CharField(max_length=30, required=False, label=ugettext_lazy('Requested by'), widget=forms.TextInput(attrs={'size':'12'}))
+    date_from = forms.DateField(required=False, label=ugettext_lazy('From'), widget=forms.TextInput(attrs={'size':'10'}))
+    date_to = forms.DateField(required=False, label=ugettext_lazy('To'), widget=forms.TextInput(attrs={'size':'10'}))
+    
+    def filter(self, queryset):
+        """ Applies the filters to a ticket queryset; invalid filters match nothing. """
+        if not self.is_valid():
+            return queryset.none()
+        
+        data = self.cleaned_data
+        lookups = {
+            'topic': data['topic'],
+            'topic__grant': data['grant'],
+            'state': data['state'],
+            'payment_status': data['payment_status'],
+            'sort_date__gte': data['date_from'],
+            'sort_date__lte': data['date_to'],
+        }
+        queryset = queryset.filter(**dict([(k, v) for k, v in lookups.items() if v not in (None, '')]))
+        if data['requester']:
+            # the requester as shown, see Ticket.requested_by()
+            queryset = queryset.filter(Q(requested_user__username=data['requester']) | Q(requested_user__isnull=True, requested_text=data['requester']))
+        return queryset
+
+class TransactionDateForm(forms.Form):
+    """ Transaction date range, taken from the query string. """
+    date_from = forms.DateField(required=False, label=ugettext_lazy('From'), widget=forms.TextInput(attrs={'size':'10'}))
+    date_to = forms.DateField(required=False, label=ugettext_lazy('To'), widget=forms.TextInput(attrs={'size':'10'}))
+    
+    def filter(self, queryset):
+        """ Applies the range to a transaction queryset; invalid ranges match nothing. """
+        if not self.is_valid():
+            return queryset.none()
+        
+        data = self.cleaned_data
+        if data['date_from'] is not None:
+            queryset = queryset.filter(date__gte=data['date_from'])
+        if data['date_to'] is not None:
+            queryset = queryset.filter(date__lte=data['date_to'])
+        return queryset
+
+class KeysetPageMixin(object):
+    """
+    Pages of a queryset, newest first, by (date_field, id) cursors in
+    'after'/'before' parameters.
+    """
+    date_field = None
+    page_size_setting = None
+    
+    def cursor(self, item):
+        return '%s_%d' % (getattr(item, self.date_field).isoformat(), item.id)
+    
+    @staticmethod
+    def parse_cursor(value):
+        try:
+            date, item_id = value.split('_')
+            return datetime.datetime.strptime(date, '%Y-%m-%d').date(), int(item_id)
+        except ValueError:
+            return None
+    
+    def keyset_page(self, qs):
+        """ Returns the requested page of qs as a list; sets has_previous and has_next. """
+        field = self.date_field
+        page_size = getattr(settings, self.page_size_setting, 100)
+        before = self.parse_cursor(self.request.GET.get('before', ''))
+        after = self.parse_cursor(self.request.GET.get('after', ''))
+        # the plain range bound next to the (date, id) comparison lets the
+        # database seek the (date_field, id) index instead of scanning it
+        if before is not None:
+            date, item_id = before
+            items = list(qs.filter(Q(**{field + '__gt': date}) | Q(**{field: date, 'id__gt': item_id}), **{field + '__gte': date}).order_by(field, 'id')[:page_size + 1])
+            if items:
+                self.has_previous, self.has_next = len(items) > page_size, True
+                return items[page_size - 1::-1]
+            after = None # nothing newer, show the first page
+        
+        if after is not None:
+            date, item_id = after
+            qs = qs.filter(Q(**{field + '__lt': date}) | Q(**{field: date, 'id__lt': item_id}), **{field + '__lte': date})
+        items = list(qs.order_by('-' + field, '-id')[:page_size + 1])
+        self.has_previous, self.has_next = after is not None and len(items) > 0, len(items) > page_size
+        return items[:page_size]
+    
+    def page_url(self, **cursor):
+        query = self.request.GET.copy()
+        for key in ('before', 'after', 'rows'): # 'rows' asks for the bare rows of a page, see TopicDetailView
+            query.pop(key, None)
+        query.update(cursor)
+        return '?' + query.urlencode()
+    
+    def page_links(self, items):
+        """ previous_page_url and next_page_url context of the page with given items. """
+        links = {}
+        if self.has_previous:
+            links['previous_page_url'] = self.page_url(before=self.cursor(items[0]))
+        if self.has_next:
+            links['next_page_url'] = self.page_url(after=self.cursor(items[-1]))
+        return links
+
+class KeysetListView(KeysetPageMixin, ListView):
+    """ List view paginated by KeysetPageMixin; the filter_form_class form filters it. """
+    filter_form_class = None
+    
+    def get_queryset(self):
+        self.filter_form = self.filter_form_class(self.request.GET)
+        return self.keyset_page(self.filter_form.filter(super(KeysetListView, self).get_queryset()))
+    
+    def get_context_data(self, **kwargs):
+        context = super(KeysetListView, self).get_context_data(**kwargs)
+        context['filter_form'] = self.filter_form
+        context.update(self.page_links(context['object_list']))
+        return context
+
+class TicketListView(KeysetListView):
+    """ Ticket list, newest first, paginated by (sort_date, id) cursors. """
+    template_name = 'tracker/ticket_list.html'
+    context_object_name = 'ticket_list'
+    date_field = 'sort_date'
+    filter_form_class = TicketFilterForm
+    page_size_setting = 'TRACKER_TICKETS_PER_PAGE'
+    queryset = Ticket.objects.with_summaries()
+ticket_list = TicketListView.as_view()
+
+def page_etag(request, *parts):
+    """
+    ETag of a page showing given parts of the database, or None (always render
+    the page) when it is going to show messages. The user, language and CSRF
+    token the page is rendered with are part of the tag too.
+    """
+    if 'c' in request.GET or len(messages.get_messages(request)) > 0:
+        return None
+    user = request.user
+    parts += (user.id, user.username, user.is_staff, translation.get_language(), request.META.get('CSRF_COOKIE'))
+    return hashlib.md5(repr(parts)).hexdigest()
+
+def comment_state(model, pk):
+    """ Changes whenever comments of given object are posted, hidden or removed. """
+    content_type = ContentType.objects.get_for_model(model)
+    return list(comments.get_model().objects.filter(content_type=content_type, object_pk=unicode(pk)).values_list('id', 'is_public', 'is_removed'))
+
+def ticket_detail_permissions(ticket, user):
+    """ The ways given user may change the ticket, as shown by its detail page. """
+    return {
+        'user_can_edit_ticket': ticket.can_edit(user),
+        'user_can_edit_ticket_in_admin': user.is_staff and (user.has_perm('tracker.supervisor') or user.topic_set.filter(id=ticket.topic_id).exists()),
+        'user_can_edit_documents': ticket.can_edit_documents(user),
+        'user_can_see_documents': ticket.can_see_documents(user),
+    }
+
+def ticket_detail_etag(request, pk):
+    tickets = list(Ticket.objects.filter(id=pk))
+    if not tickets:
+        return None
+    ticket = tickets[0]
+    # row_version covers acks, media, expeditures and payment status
+    return page_etag(request, ticket.updated, ticket.row_version,
+        list(Cluster.objects.filter(id=ticket.cluster_id).values_list('more_tickets', 'total_tickets', 'total_transactions')),
+        list(ticket.transaction_set.values_list('id', 'date', 'amount', 'description', 'other', 'other_text', 'accounting_info')),
+        list(ticket.document_set.values_list('id', 'filename', 'size', 'description')),
+        comment_state(Ticket, pk), sorted(ticket_detail_permissions(ticket, request.user).items()))
+
 class TicketDetailView(CommentPostedCatcher, DetailView):
     model = Ticket
     
     def get_context_data(self, **kwargs):
-        user = self.request.user
-        ticket = self.object
         context = super(TicketDetailView, self).get_context_data(**kwargs)
-        context['user_can_edit_ticket'] = ticket.can_edit(user)
-        admin_edit = user.is_staff and (user.has_perm('tracker.supervisor') or user.topic_set.filter(id=ticket.topic_id).exists())
-        context['user_can_edit_ticket_in_admin'] = admin_edit
-        context['user_can_edit_documents'] = ticket.can_edit_documents(user)
-        context['user_can_see_documents'] = ticket.can_see_documents(user)
+        context.update(ticket_detail_permissions(self.object, self.request.user))
         return context
-ticket_detail = TicketDetailView.as_view()
+ticket_detail = condition(etag_func=ticket_detail_etag)(TicketDetailView.as_view())
 
 class TicketAckDeleteView(DeleteView):
     model = TicketAck
@@ -69,19 +237,109 @@ class TicketAckDeleteView(DeleteView):
         return HttpResponseRedirect(self.ticket.get_absolute_url())
 ticket_ack_delete = TicketAckDeleteView.as_view()
 
-class TopicDetailView(CommentPostedCatcher, DetailView):
-    model = Topic
-topic_detail = TopicDetailView.as_view()
+def ticket_set_state(tickets):
+    """ Changes whenever any of given tickets changes (see Ticket.row_version), or the set does. """
+    return tickets.aggregate(models.Count('id'), models.Max('updated'), models.Sum('row_version'))
 
-def topics_js(request):
-    data = {}
-    for t in Topic.objects.all():
-        data[t.id] = {}
-        for attr in ('form_description', 'ticket_media', 'ticket_expenses'):
-            data[t.id][attr] = getattr(t, attr)
+class TopicListView(ListView):
+    queryset = Topic.objects.select_related('grant')
     
-    content = 'topics_table = %s;' % json.dumps(data)
-    return HttpResponse(content, content_type='text/javascript')
+    def get_context_data(self, **kwargs):
+        context = super(TopicListView, self).get_context_data(**kwargs)
+        Topic.prefetch_table(context['object_list'])
+        return context
+topic_list = TopicListView.as_view()
+
+def topic_detail_etag(request, pk):
+    topics = list(Topic.objects.filter(id=pk).values())
+    if not topics:
+        return None
+    return page_etag(request, sorted(topics[0].items()), ticket_set_state(Ticket.objects.filter(topic=pk)), comment_state(Topic, pk),
+        list(Topic.admin.through.objects.filter(topic=pk).values_list('user', 'user__username').order_by('id')),
+        list(Grant.objects.filter(topic=pk).values_list('short_name', 'slug')))
+
+class TopicDetailView(KeysetPageMixin, CommentPostedCatcher, DetailView):
+    """
+    Topic with a page of its tickets and the summary of all of them; with
+    'rows' parameter only the ticket rows of the page, for loading them lazily.
+    """
+    queryset = Topic.summary_queryset()
+    date_field = 'sort_date'
+    page_size_setting = 'TRACKER_TICKETS_PER_PAGE'
+    
+    def get_template_names(self):
+        if 'rows' in self.request.GET:
+            return ['tracker/topic_ticket_rows.html']
+        return super(TopicDetailView, self).get_template_names()
+    
+    def get_context_data(self, **kwargs):
+        context = super(TopicDetailView, self).get_context_data(**kwargs)
+        context['ticket_list'] = self.keyset_page(self.object.ticket_set.with_summaries())
+        context.update(self.page_links(context['ticket_list']))
+        return context
+topic_detail = condition(etag_func=topic_detail_etag)(TopicDetailView.as_view())
+
+def grant_detail_etag(request, slug):
+    grants = list(Grant.objects.filter(slug=slug).values())
+    if not grants:
+        return None
+    topics = Topic.objects.filter(grant__slug=slug)
+    return page_etag(request, [sorted(grant.items()) for grant in grants],
+        [sorted(topic.items()) for topic in topics.values()],
+        list(Topic.admin.through.objects.filter(topic__in=topics).values_list('topic', 'user__username').order_by('id')),
+        [sorted(row.values().items()) for row in FinanceSnapshot.objects.filter(topic_id__in=list(topics.values_list('id', flat=True))).order_by('id')])
+
+class GrantDetailView(DetailView):
+    model = Grant
+    
+    def get_context_data(self, **kwargs):
+        context = super(GrantDetailView, self).get_context_data(**kwargs)
+        context['topic_list'] = self.object.topic_set.all()
+        Topic.prefetch_table(context['topic_list'])
+        return context
+grant_detail = condition(etag_func=grant_detail_etag)(GrantDetailView.as_view())
+
+# serialized topics.js variants of the current topic_form_data() version
+_topics_js = {}
+
+def topics_js_content(request):
+    """
+    Returns (version, content) of topics.js; with 'open' parameter only topics
+    open for tickets are included, plus the one in 'topic' parameter.
+    """
+    version, topics = topic_form_data()
+    # only the variants that differ get kept, whatever the parameters are
+    open_only = bool(request.GET.get('open'))
+    extra_topic = None
+    if open_only:
+        try:
+            extra_topic = int(request.GET.get('topic', ''))
+        except ValueError:
+            pass
+        if extra_topic not in topics or topics[extra_topic]['open_for_tickets']:
+            extra_topic = None
+    variant = (open_only, extra_topic)
+    if _topics_js.get('version') != version:
+        _topics_js.clear()
+        _topics_js['version'] = version
+    if variant not in _topics_js:
+        data = {}
+        for topic_id, fields in topics.items():
+            if open_only and not fields['open_for_tickets'] and topic_id != extra_topic:
+                continue
+            data[topic_id] = dict([(attr, fields[attr]) for attr in ('form_description', 'ticket_media', 'ticket_expenses')])
+        _topics_js[variant] = 'topics_table = %s;' % json.dumps(data)
+    return version, _topics_js[variant]
+
+def topics_js_etag(request):
+    return hashlib.md5(topics_js_content(request)[1]).hexdigest()
+
+def topics_js_last_modified(request):
+    return datetime.datetime.utcfromtimestamp(int(topics_js_content(request)[0]))
+
+@condition(etag_func=topics_js_etag, last_modified_func=topics_js_last_modified)
+def topics_js(request):
+    return HttpResponse(topics_js_content(request)[1], content_type='text/javascript')
 
 class TicketForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
@@ -91,14 +349,18 @@ class TicketForm(forms.ModelForm):
     def get_topic_queryset(self):
         return Topic.objects.filter(open_for_tickets=True)
     
+    def get_topics_js_url(self):
+        return reverse('topics_js') + '?open=1'
+    
     def _media(self):
-        return super(TicketForm, self).media + forms.Media(js=('ticketform.js', reverse('topics_js')))
+        return super(TicketForm, self).media + forms.Media(js=('ticketform.js', self.get_topics_js_url()))
     media = property(_media)
     
     class Meta:
         model = Ticket
         exclude = ('created', 'updated', 'sort_date', 'requested_user', 'requested_text',
-            'custom_state', 'rating_percentage', 'supervisor_notes', 'cluster', 'payment_status')
+            'custom_state', 'rating_percentage', 'supervisor_notes', 'cluster', 'payment_status',
+            'cluster_update_pending', 'ack_mask', 'state', 'row_version')
         widgets = {
             'event_date': adminwidgets.AdminDateWidget(),
             'summary': forms.TextInput(attrs={'size':'40'}),
@@ -109,6 +371,9 @@ def get_edit_ticket_form_class(ticket):
     class EditTicketForm(TicketForm):
         def get_topic_queryset(self):
             return Topic.objects.filter(Q(open_for_tickets=True) | Q(id=ticket.topic.id))
+        
+        def get_topics_js_url(self):
+            return reverse('topics_js') + '?open=1&topic=%d' % ticket.topic_id
     
     return EditTicketForm
 
@@ -320,17 +585,24 @@ def download_document(request, ticket_id, filename):
     return sendfile(request, doc.payload.path, mimetype=doc.content_type)
 
 def topic_finance(request):
+    snapshot = FinanceSnapshot.load()
+    grant_topics = {}
+    for topic in Topic.objects.all():
+        grant_topics.setdefault(topic.grant_id, []).append(topic)
+    
+    def snapshot_row(topic_id, grant_id):
+        return snapshot.get((topic_id, grant_id)) or FinanceSnapshot(topic_id=topic_id, grant_id=grant_id)
+    
     grants_out = []
     for grant in Grant.objects.all():
         topics = []
-        grant_finance = FinanceStatus()
-        for topic in grant.topic_set.all():
-            topic_finance = topic.payment_summary()
-            grant_finance.add_finance(topic_finance)
-            topics.append({'topic':topic, 'finance':topic_finance})
-        grants_out.append({'grant':grant, 'topics':topics, 'finance':grant_finance, 'rows':len(topics)+1})
-    
-    csums = Cluster.cluster_sums()
+        for topic in grant_topics.get(grant.id, []):
+            topic_row = snapshot_row(topic.id, grant.id)
+            topics.append({'topic':topic, 'finance':topic_row.finance(), 'tickets':topic_row.tickets})
+        grants_out.append({'grant':grant, 'topics':topics, 'finance':snapshot_row(None, grant.id).finance(), 'rows':len(topics)+1})
+    
+    total = snapshot[(None, None)]
+    csums = {'unpaid':total.unpaid, 'paid':total.paid, 'overpaid':total.overpaid}
     return render(request, 'tracker/topic_finance.html', {
         'grants': grants_out,
         'cluster_sums': csums,
@@ -338,52 +610,108 @@ def topic_finance(request):
         'have_fuzzy': any([row['finance'].fuzzy for row in grants_out]),
     })  
 
-def transaction_list(request):
-    return render(request, 'tracker/transaction_list.html', {
-        'transaction_list': Transaction.objects.all(),
-        'total': Transaction.objects.aggregate(amount=models.Sum('amount'))['amount'],
-    })
+class TransactionListView(KeysetListView):
+    """ Transaction list, newest first, paginated by (date, id) cursors. """
+    template_name = 'tracker/transaction_list.html'
+    context_object_name = 'transaction_list'
+    date_field = 'date'
+    filter_form_class = TransactionDateForm
+    page_size_setting = 'TRACKER_TRANSACTIONS_PER_PAGE'
+    queryset = Transaction.objects.select_related('other')
+    
+    def get_queryset(self):
+        transactions = super(TransactionListView, self).get_queryset()
+        Transaction.prefetch_links(transactions)
+        return transactions
+    
+    def get_context_data(self, **kwargs):
+        context = super(TransactionListView, self).get_context_data(**kwargs)
+        form = self.filter_form
+        if not form.is_valid(): # nothing shown (aggregating none() would sum everything)
+            context['total'] = 0
+        elif any(form.cleaned_data.values()): # total of the date range shown
+            context['total'] = form.filter(Transaction.objects.all()).aggregate(amount=models.Sum('amount'))['amount'] or 0
+        else:
+            context['total'] = Transaction.total()
+        return context
+transaction_list = TransactionListView.as_view()
+
+def transaction_csv_lines(transactions, chunk_size=CHUNK_SIZE):
+    """
+    Yields CSV lines of given transactions, newest first, a chunk of lines at
+    a time. Transactions are read in (date, id) keyset chunks; their tickets,
+    grants and users are fetched in bulk for each chunk.
+    """
+    def line(row):
+        return u';'.join(map(lambda s: unicode(s).replace(';', ',').replace('\n', ' '), row)) + u'\r\n'
+    
+    yield line(['DATE', 'OTHER PARTY', 'AMOUNT ' + unicode(settings.TRACKER_CURRENCY), 'DESCRIPTION', 'TICKETS', 'GRANTS', 'ACCOUNTING INFO'])
+    
+    links = Transaction.tickets.through.objects
+    fields = ('id', 'date', 'other', 'other_text', 'amount', 'description', 'accounting_info')
+    transactions = transactions.order_by('-date', '-id').values(*fields)
+    chunk = list(transactions[:chunk_size])
+    while chunk:
+        ids = [tx['id'] for tx in chunk]
+        tickets, grants = {}, {}
+        for transaction_id, ticket_id in links.filter(transaction__in=ids).order_by('-ticket__sort_date', 'ticket').values_list('transaction', 'ticket'):
+            tickets.setdefault(transaction_id, []).append(unicode(ticket_id))
+        for transaction_id, short_name in links.filter(transaction__in=ids).order_by('ticket__topic__grant').values_list('transaction', 'ticket__topic__grant__short_name').distinct():
+            grants.setdefault(transaction_id, []).append(short_name)
+        usernames = dict(User.objects.filter(id__in=set([tx['other'] for tx in chunk if tx['other'] is not None])).values_list('id', 'username'))
+        
+        yield u''.join([line([
+            tx['date'].strftime('%Y-%m-%d'),
+            usernames[tx['other']] if tx['other'] is not None else tx['other_text'],
+            tx['amount'],
+            tx['description'],
+            u' '.join(tickets.get(tx['id'], [])),
+            u' '.join(grants.get(tx['id'], [])),
+            tx['accounting_info'],
+        ]) for tx in chunk])
+        
+        last = chunk[-1]
+        chunk = list(transactions.filter(Q(date__lt=last['date']) | Q(date=last['date'], id__lt=last['id']), date__lte=last['date'])[:chunk_size])
 
 def transactions_csv(request):
-    response = HttpResponse(mimetype='text/csv')
-    def writerow(row):
-        response.write(u';'.join(map(lambda s: unicode(s).replace(';', ',').replace('\n', ' '), row)))
-        response.write(u'\r\n')
-    
-    writerow(['DATE', 'OTHER PARTY', 'AMOUNT ' + unicode(settings.TRACKER_CURRENCY), 'DESCRIPTION', 'TICKETS', 'GRANTS', 'ACCOUNTING INFO'])
-    
-    for tx in Transaction.objects.all():
-        writerow([
-            tx.date.strftime('%Y-%m-%d'),
-            tx.other_party(),
-            tx.amount,
-            tx.description,
-            u' '.join([unicode(t.id) for t in tx.tickets.all()]),
-            u' '.join([g.short_name for g in tx.grant_set()]),
-            tx.accounting_info,
-        ])
-    return response
+    """ Streams all the transactions, or those in date_from/date_to range (inclusive), as CSV. """
+    form = TransactionDateForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Invalid date range')
+    return HttpResponse(transaction_csv_lines(form.filter(Transaction.objects.all())), mimetype='text/csv')
 
 def user_list(request):
+    summaries = UserProfile.summaries()
     totals = {
-        'ticket_count': Ticket.objects.count(),
-        'media': MediaInfo.objects.aggregate(objects=models.Count('id'), media=models.Sum('count')),
-        'accepted_expeditures': sum([t.accepted_expeditures() for t in Ticket.objects.filter(rating_percentage__gt=0)]),
-        'transactions': Transaction.objects.aggregate(amount=models.Sum('amount'))['amount'],
+        'ticket_count': sum([row['ticket_count'] for row in summaries.values()]),
+        'media': {
+            'objects': sum([row['media']['objects'] for row in summaries.values()]),
+            'media': sum([row['media']['media'] or 0 for row in summaries.values()]),
+        },
+        'accepted_expeditures': sum([row['accepted_expeditures'] for row in summaries.values()]),
+        'transactions': sum([row['transactions']['amount'] or 0 for row in summaries.values()]),
     }
     
-    userless = Ticket.objects.filter(requested_user=None)
-    if userless.count() > 0:
+    unassigned = summaries.get(None)
+    if unassigned is not None and unassigned['ticket_count'] > 0:
         unassigned = {
-            'ticket_count': userless.count(),
-            'media': MediaInfo.objects.extra(where=['ticket_id in (select id from tracker_ticket where requested_user_id is null)']).aggregate(objects=models.Count('id'), media=models.Sum('count')),
-            'accepted_expeditures': sum([t.accepted_expeditures() for t in userless]),
+            'ticket_count': unassigned['ticket_count'],
+            'media': unassigned['media'],
+            'accepted_expeditures': unassigned['accepted_expeditures'],
         }
     else:
         unassigned = None
     
+    paginator = Paginator(User.objects.order_by('id'), getattr(settings, 'TRACKER_USERS_PER_PAGE', 100))
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except (PageNotAnInteger, EmptyPage):
+        raise Http404
+    user_list = [dict(summaries.get(user.id, {}), user=user) for user in page.object_list]
+    
     return render(request, 'tracker/user_list.html', {
-        'user_list': User.objects.all(),
+        'user_list': user_list,
+        'page': page,
         'unassigned': unassigned,
         'totals': totals,
     })
@@ -394,7 +722,7 @@ def user_detail(request, username):
     return render(request, 'tracker/user_detail.html', {
         'user_obj': user,
         # ^ NOTE 'user' means session user in the template, so we're using user_obj
-        'ticket_list': user.ticket_set.all(),
+        'ticket_list': user.ticket_set.with_summaries(),
     })
 
 class UserDetailsChange(FormView):
@@ -435,21 +763,61 @@ class UserDetailsChange(FormView):
         
 user_details_change = login_required(UserDetailsChange.as_view())
 
+def cluster_detail_etag(request, pk):
+    """
+    The stored cluster fields stand for the whole cluster, so only the rows
+    on the requested pages are read; large clusters cost no more than small.
+    """
+    clusters = list(Cluster.objects.filter(id=pk).values_list('more_tickets', 'total_tickets', 'total_transactions', 'ticket_count', 'transaction_count', 'topic_count'))
+    if not clusters:
+        return None # redirect or 404
+    
+    rows = []
+    for name, queryset, page_size_setting, fields in (
+            ('tickets', Ticket.objects.filter(cluster=pk).order_by('-sort_date', '-id'), 'TRACKER_TICKETS_PER_PAGE', ('id', 'updated', 'row_version')),
+            ('transactions', Transaction.objects.filter(cluster=pk).order_by('-date', '-id'), 'TRACKER_TRANSACTIONS_PER_PAGE',
+                ('id', 'date', 'amount', 'description', 'other', 'other__username', 'other_text', 'accounting_info'))):
+        page_size = getattr(settings, page_size_setting, 100)
+        try:
+            start = (int(request.GET.get(name, 1)) - 1) * page_size
+        except ValueError:
+            return None # 404
+        if start < 0:
+            return None
+        rows.append(list(queryset.values_list(*fields)[start:start + page_size]))
+    links = Transaction.tickets.through.objects.filter(transaction__in=[row[0] for row in rows[1]])
+    return page_etag(request, clusters, rows, list(links.values_list('transaction', 'ticket', 'ticket__row_version').order_by('id')))
+
+@condition(etag_func=cluster_detail_etag)
 def cluster_detail(request, pk):
     id = int(pk)
     try:
         cluster = Cluster.objects.get(id=id)
     except Cluster.DoesNotExist:
+        # ticket ids are accepted too, for the cluster of the ticket
+        cluster_ids = list(Ticket.objects.filter(id=id).values_list('cluster', flat=True))
+        if not cluster_ids or cluster_ids[0] is None:
+            raise Http404
+        return HttpResponseRedirect(reverse('cluster_detail', kwargs={'pk':cluster_ids[0]}))
+    
+    # both member lists are paginated, by 'tickets' and 'transactions' page numbers
+    pages = {}
+    for name, queryset, page_size_setting in (
+            ('tickets', cluster.ticket_set.with_summaries().order_by('-sort_date', '-id'), 'TRACKER_TICKETS_PER_PAGE'),
+            ('transactions', cluster.transaction_set.select_related('other').order_by('-date', '-id'), 'TRACKER_TRANSACTIONS_PER_PAGE')):
+        paginator = Paginator(queryset, getattr(settings, page_size_setting, 100))
         try:
-            ticket = Ticket.objects.get(id=id)
-            if ticket.cluster is None:
-                raise Http404
-            return HttpResponseRedirect(reverse('cluster_detail', kwargs={'pk':ticket.cluster.id}))
-        except Ticket.DoesNotExist:
+            pages[name] = paginator.page(request.GET.get(name, 1))
+        except (PageNotAnInteger, EmptyPage):
             raise Http404
+        pages[name].object_list = list(pages[name].object_list)
+    Transaction.prefetch_links(pages['transactions'].object_list)
     
     return render(request, 'tracker/cluster_detail.html', {
         'cluster': cluster,
+        'ticket_page': pages['tickets'],
+        'ticket_list': pages['tickets'].object_list,
+        'transaction_page': pages['transactions'],
         'ticket_summary': {'accepted_expeditures': cluster.total_tickets},
     })
     